@@ -1,10 +1,22 @@
+import time
+_START_TIME = time.perf_counter() # for the startup-phase timings
+
 import streamlit as st
+import numpy as np
 import pandas as pd
+import os
+import queue
+import threading
+import contextlib
 from os import path
 from PIL import Image
 
-from data_loader import prepare_all_data, construct_table_from_lookups
-from clip_analyzer import load_clip, get_img_txt_similarity
+# `clip_analyzer` (and with it torch & transformers) is only imported once CLIP is actually needed
+from data_loader import prepare_all_data, construct_table_from_lookups, construct_highlight_mask, search_evidences
+from embedding_store import TEXT_CACHE_FILENAME, load_embedding_store, load_ann_index, row_doc_ids
+from image_cache import get_thumbnail, get_pixel_values
+from instrumentation import metrics, profiled, lru_cache_stats
+from job_queue import ClipJobQueue
 
 
 # Streamlit configs & title
@@ -20,10 +32,166 @@ IMGS_JSONL_PATH = path.join(DATA_DIR, 'multimodalqa_final_dataset_pipeline_camer
 IMG_FILES_DIR = path.join(DATA_DIR, 'final_dataset_images')
 TABS_PATH = path.join(DATA_DIR, 'multimodalqa_final_dataset_pipeline_camera_ready_MMQA_tables.jsonl')
 TXTS_PATH = path.join(DATA_DIR, 'multimodalqa_final_dataset_pipeline_camera_ready_MMQA_texts.jsonl')
+EMBEDDINGS_DIR = path.join(DATA_DIR, 'clip_embeddings') # built by `python embedding_store.py`
+THUMBNAILS_DIR = path.join(DATA_DIR, 'thumbnails') # pre-generated by `python image_cache.py`, otherwise on first display
+
+# CLIP inference settings, overridable through environment variables (e.g., `CLIP_BACKEND=int8 streamlit run app.py`)
+CLIP_SETTINGS = {
+    'backend': os.environ.get('CLIP_BACKEND', 'fp32'), # one of 'fp32', 'bf16', 'int8', 'onnx'
+    'num_threads': int(os.environ['CLIP_NUM_THREADS']) if os.environ.get('CLIP_NUM_THREADS') else None,
+}
+if os.environ.get('CLIP_CHECKPOINT'):
+    CLIP_SETTINGS['checkpoint'] = os.environ['CLIP_CHECKPOINT'] # otherwise `clip_analyzer.CLIP_CHECKPOINT`
+# Whether to load CLIP in a background thread right after the first page is rendered, instead of on the first similarity request
+CLIP_WARMUP = os.environ.get('CLIP_WARMUP', '0') == '1'
+# Maximum number of pending CLIP similarity jobs of all sessions, and how often pending jobs are polled
+CLIP_QUEUE_SIZE = int(os.environ.get('CLIP_QUEUE_SIZE', '64'))
+JOB_POLL_SECONDS = 0.5
+# Index of the text-to-image retrieval: 'exact' (NumPy), or the approximate 'hnsw' / 'ivf' (require `faiss`)
+RETRIEVAL_INDEX = os.environ.get('RETRIEVAL_INDEX', 'exact')
+# Opt-in instrumentation: '1' records stage timings & cache hit rates, 'memory' also traces Python allocations (slower)
+INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '0')
+METRICS_DIR = path.join(DATA_DIR, 'metrics') # rolling metrics log, profiles & flame graph stacks
+
+if INSTRUMENTATION != '0' and not metrics.enabled:
+    metrics.enable(trace_memory=INSTRUMENTATION == 'memory', log_path=path.join(METRICS_DIR, 'metrics.jsonl'))
+    metrics.register_cache("pixel values (LRU)", lambda: lru_cache_stats(get_pixel_values))
+    metrics.register_cache("tables (st.cache_resource)", lambda: (metrics.counter('cache_table.calls') - metrics.counter('cache_table.misses'),
+                                                              metrics.counter('cache_table.misses')))
+    metrics.register_cache("image embeddings (store)", lambda: (metrics.counter('embedding_store.hits'), metrics.counter('embedding_store.misses')))
+# Profile this run if requested from the debug panel (the flag is consumed before the button is drawn again)
+_profile_requested = st.session_state.pop('profile_next_run', False)
+
+# Define helper functions to rank an image evidence among the conversation's image evidences
+# CLIP runs in a background job queue shared by all sessions, so that the page stays responsive while it works
+def submit_similarity_job(question: str, img_id: str, img_path: str, conv_img_ids: list[str]) -> tuple | None:
+    """Submit the Q-I CLIP scoring of an image evidence and the conversation's other image evidences, returning the job's key."""
+    # Get all other image evidence instances in the entire conversation for later similarity computations
+    # (skipping the current/same image evidence instance to avoid self-comparison)
+    conv_imgs = [d for d in conv_img_ids if d != img_id and d in imgs_lookups]
+    doc_ids = [img_id] + conv_imgs
+    img_paths = [img_path] + [path.join(IMG_FILES_DIR, imgs_lookups[d].get('path')) for d in conv_imgs]
+    try:
+        return clip_job_queue().submit(question, doc_ids, img_paths).key
+    except queue.Full:
+        st.warning("CLIP is busy with other requests -- please try again in a moment.")
+        return None
+
+def display_similarity_job(job_state: str) -> None:
+    """Display the result of the similarity job kept in `st.session_state[job_state]`, or poll it until it finished."""
+    state = st.session_state[job_state]
+    if isinstance(state, dict): # finished and copied into the session
+        display_similarity_result(state)
+    elif not collect_similarity_job(job_state):
+        poll_similarity_job(job_state)
+
+def collect_similarity_job(job_state: str) -> bool:
+    """
+    Copy the result of a finished similarity job into the session, as the queue forgets it after its `result_ttl`.
+
+    Args:
+        job_state (str): Session state key holding the job's key (see `submit_similarity_job`).
+
+    Returns:
+        collected (bool): Whether the job is over, i.e., finished (its result is now in the session) or expired.
+    """
+    job = clip_job_queue().get(st.session_state[job_state])
+    if job is None: # expired before this session saw it finish
+        st.session_state[job_state] = {'scores': None, 'error': "The result expired -- please analyze again."}
+    elif job.done():
+        st.session_state[job_state] = {'scores': job.scores, 'error': job.error}
+    else:
+        return False
+    return True
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def poll_similarity_job(job_state: str) -> None:
+    """Show the progress of a pending similarity job -- only this fragment reruns while polling."""
+    if collect_similarity_job(job_state):
+        # Rerun once so that the card renders the result from the session and this fragment (and its timer) is gone
+        st.rerun()
+    job = clip_job_queue().get(st.session_state[job_state])
+    status = "Loading CLIP..." if clip_holder()['model'] is None else ("Running CLIP..." if job.status == 'running' else "Waiting for CLIP...")
+    st.caption(f"⏳ {status} ({time.time() - job.submitted:.0f}s)")
+
+def display_similarity_result(result: dict) -> None:
+    """Display the scores of a finished similarity job, or its error."""
+    if result['error'] is not None:
+        # Only this card reports a failing model, the rest of the page keeps working
+        st.error(f"Error running the CLIP model: {result['error']}")
+    else:
+        display_similarity_scores(result['scores'])
+
+@metrics.timed()
+def display_similarity_scores(all_scores: np.ndarray) -> None:
+    """Display the Q-I CLIP score of an image evidence (first) and its rank within the conversation's image evidences (the rest)."""
+    # Compute the CLIP score between the question and the image instance (as the baseline)
+    score = float(all_scores[0])
+    st.metric(label="CLIP Score", value=f"{score:.2f}") # Display the CLIP score for the current image instance first
+    # Similarity scores between the question and all other image instances in the conversation for ranking
+    scores = all_scores[1:].tolist()
+    # Rank if more than one image instance (other than the current/same one)
+    if len(scores) >= 1:
+        rank = sum(1 for s in scores if s > score) + 1 # count up all scores that are greater than the current score and add 1 for the current instance
+        st.metric(label="All Other Image Evidences' CLIP Scores within the Conversation", value=", ".join([f"{s:.2f}" for s in scores]))
+        st.metric(label="Rank (Position) among all Image Evidences within the Conversation", value=f"{rank} / {len(scores) + 1}") # +1 for the current instance
+    else:
+        st.write("No other image evidences in the conversation -- No Ranking Applied.")
+
+# Define helper function to retrieve images for a question from the precomputed embeddings
+@st.fragment
+def display_retrieval_panel(conv: list[dict], conv_img_ids: list[str]) -> None:
+    """Retrieve the top-k images for a question of the conversation (or any query), within the conversation or the full image pool."""
+    with st.container(border=True):
+        if not st.toggle("Text-to-Image Retrieval", key="open_retrieval"):
+            return
+        turns = {turn['qid']: turn for turn in conv}
+        choice = st.selectbox("Query", list(turns) + ['Custom'], format_func=lambda qid: f"{qid}: {turns[qid]['question']}" if qid in turns else "Custom Query")
+        query = st.text_input("Custom Query") if choice not in turns else turns[choice]['question']
+        scope = st.radio("Search in", ["Full Image Pool", "This Conversation"], horizontal=True)
+        k = st.slider("Top-k", min_value=1, max_value=50, value=10)
+        if not (st.button("Retrieve Images", key="retrieve") and query):
+            return
+        search_index = cache_search_index()
+        if search_index is None:
+            st.warning("No precomputed image embeddings found -- build them with `python embedding_store.py` first.")
+            return
+        matrix, doc_ids, ann_index = search_index
+        try:
+            model, processor = get_clip()
+        except Exception as e:
+            st.error(f"Error loading the CLIP model: {e}")
+            return
+        from clip_analyzer import retrieve_images, recall_at_k
+        candidate_rows = None
+        if scope == "This Conversation":
+            rows = cache_embedding_store()[1]
+            candidate_rows = np.array(sorted({rows[d][0] for d in conv_img_ids if d in rows}), dtype=np.int64)
+        start = time.perf_counter()
+        with metrics.stage('clip.retrieve_images'):
+            results = retrieve_images(query, model, processor, matrix, doc_ids, k=k, candidate_rows=candidate_rows, ann_index=ann_index,
+                                      cache=text_embeddings())
+        st.caption(f"Retrieved {len(results)} of {len(doc_ids) if candidate_rows is None else len(candidate_rows)} images in {(time.perf_counter() - start) * 1000:.0f} ms.")
+        # Evaluate against the gold image evidences of the chosen turn
+        gold_ids = [inst['doc_id'] for a in turns[choice]['answer'] if a.get('modality') == 'image'
+                    for inst in a.get('image_instances', [])] if choice in turns else []
+        if gold_ids:
+            st.metric(label=f"Recall@{k} against the Gold Image Evidences", value=f"{recall_at_k([d for d, _ in results], gold_ids):.2f}")
+        for row_start in range(0, len(results), 5):
+            for col, (rank, (doc_id, score)) in zip(st.columns(5), enumerate(results[row_start:row_start + 5], start=row_start + 1)):
+                img = imgs_lookups[doc_id] if doc_id in imgs_lookups else {}
+                with col:
+                    if img.get('path'):
+                        st.image(get_thumbnail(path.join(IMG_FILES_DIR, img['path']), doc_id, THUMBNAILS_DIR, size=256), use_container_width=True)
+                    st.caption(f"#{rank} ({score:.2f}) {'✅ ' if doc_id in gold_ids else ''}'{img.get('title', doc_id)}'")
 
 # Define helper function to display multi-modal evidences
-def display_evidence_card(question: str, ans: dict, turn_qid: str, card_index: int) -> None:
-    """Create a self-contained card for each answer and all its evidences."""
+# As a fragment, interacting with one card (e.g., a CLIP button) only reruns that card instead of the whole page
+@st.fragment
+@metrics.timed()
+def display_evidence_card(turn: dict, ans: dict, card_index: int, conv_img_ids: list[str]) -> None:
+    """Create a self-contained card for each answer and all its evidences, built only once the evidence is opened."""
+    question, turn_qid = turn['question'], turn['qid']
     modality = ans.get('modality')
     with st.container(height=None, border=True, key=f"card_{turn_qid}_{card_index}"):
         st.subheader(f"Answer: \"{ans['answer']}\"")
@@ -41,35 +209,19 @@ def display_evidence_card(question: str, ans: dict, turn_qid: str, card_index: i
                     # In case the image evidence failed to load
                     if path.exists(img_path):
                         # Display the image evidence with its title, image content, analysis and URL
-                        with st.expander(label=f"Instance {i+1} '{imgs_lookups[img_id].get('title', '?')}'"):
-                            st.image(img_path, caption=f"Instance {i+1} '{imgs_lookups[img_id].get('title', '?')}'", use_container_width=True)
-                            # Unique key for each button is crucial for Streamlit
-                            if st.button("Analyze Q-I Similarity", key=f"clip_{turn_qid}_{card_index}_{i}"):
-                                with st.spinner("Running CLIP..."):
-                                    # Get all image evidence instances in the entire conversation for later similarity computations
-                                    conv_imgs = []
-                                    for turn in st.session_state.current_conv:
-                                        for a in turn['answer']:
-                                            if a.get('modality') == 'image':
-                                                for inst in a['image_instances']:
-                                                    conv_imgs.append(inst['doc_id'])
-                                    # Compute the CLIP score between the question and the image instance (as the baseline)
-                                    score = get_img_txt_similarity(img_path, question, model, processor)
-                                    st.metric(label="CLIP Score", value=f"{score:.2f}") # Display the CLIP score for the current image instance first
-                                    # Compute similarity scores between the question and all image instances in the conversation and rank
-                                    scores = []
-                                    for conv_img in conv_imgs:
-                                        # Skip the current/same image evidence instance to avoid self-comparison
-                                        if conv_img != img_id:
-                                            conv_img_path = path.join(IMG_FILES_DIR, imgs_lookups[conv_img].get('path'))
-                                            scores.append(get_img_txt_similarity(conv_img_path, question, model, processor))
-                                    # Rank if more than one image instance (other than the current/same one)
-                                    if len(scores) >= 1:
-                                        rank = sum(1 for s in scores if s > score) + 1 # count up all scores that are greater than the current score and add 1 for the current instance
-                                        st.metric(label="All Other Image Evidences' CLIP Scores within the Conversation", value=", ".join([f"{s:.2f}" for s in scores]))
-                                        st.metric(label="Rank (Position) among all Image Evidences within the Conversation", value=f"{rank} / {len(scores) + 1}") # +1 for the current instance
-                                    else:
-                                        st.write("No other image evidences in the conversation -- No Ranking Applied.")
+                        # A toggle (unlike an expander) lets the content be built only once it's opened
+                        if st.toggle(f"Instance {i+1} '{imgs_lookups[img_id].get('title', '?')}'", key=f"open_{turn_qid}_{card_index}_{i}"):
+                            with st.container(border=True):
+                                # Send a fixed-size thumbnail instead of the full-resolution file to the browser
+                                with metrics.stage('get_thumbnail'): # decodes & resizes the image unless already on disk
+                                    thumb_path = get_thumbnail(img_path, img_id, THUMBNAILS_DIR)
+                                st.image(thumb_path, caption=f"Instance {i+1} '{imgs_lookups[img_id].get('title', '?')}'", use_container_width=True)
+                                # Unique key for each button is crucial for Streamlit
+                                job_state = f"job_{turn_qid}_{card_index}_{i}" # the submitted job's key, then its result
+                                if st.button("Analyze Q-I Similarity", key=f"clip_{turn_qid}_{card_index}_{i}"):
+                                    st.session_state[job_state] = submit_similarity_job(question, img_id, img_path, conv_img_ids)
+                                if st.session_state.get(job_state) is not None:
+                                    display_similarity_job(job_state)
                     else: st.warning(f"Image file `{img_filename}` not found.")
                 else: st.warning(f"Image instance with ID `{img_id}` cannot be presented.")
         elif modality == 'table' and ans.get('table_indices'):
@@ -78,24 +230,19 @@ def display_evidence_card(question: str, ans: dict, turn_qid: str, card_index: i
             # Unlike image and text evidences, table_id is provided in the "question level"
             # and every evidence is provided in indices in the "answer level"
             # Hence, get back to the "question level" to get the table ID first
-            tab_id_from_q = st.session_state.current_q.get('table_id')
+            tab_id_from_q = turn.get('table_id')
             # In case the evidence's somehow not found
             if tab_id_from_q in tabs_lookups and tabs_lookups[tab_id_from_q].get('table'):
-                tab_i = tabs_lookups[tab_id_from_q].get('table')
-                df = construct_table_from_lookups(tab_i)
-                # Highlight cells based on the indices
-                def highlight_cells(row): # function to be applied
-                    styles = [''] * len(row) # as for each row
-                    # For each pair of indices in the answer
-                    for row_idx, col_idx in ans['table_indices']:
-                        # If the indices are valid, highlight the cell
-                        if row.name == row_idx and col_idx < len(row):
-                            styles[col_idx] = 'background-color: #5CE488;' # Streamlit dark mode's green highlight
-                    return styles
                 # Display the table evidence with its title, table content and URL
-                with st.expander(label=f"Table Evidence from '{tabs_lookups[tab_id_from_q].get('title', '?')}'"):
-                    st.dataframe(df.style.apply(highlight_cells, axis=1), use_container_width=True) # for each row
-                    st.page_link(page=tabs_lookups[tab_id_from_q].get('url'), label=tabs_lookups[tab_id_from_q].get('url'))
+                if st.toggle(f"Table Evidence from '{tabs_lookups[tab_id_from_q].get('title', '?')}'", key=f"open_{turn_qid}_{card_index}_table"):
+                    metrics.count('cache_table.calls')
+                    df = cache_table(tab_id_from_q) # shared by all sessions -- never modified in place
+                    # Highlight cells based on the indices, with the styles computed for all cells at once
+                    mask = construct_highlight_mask(df.shape, ans['table_indices'])
+                    styles = np.where(mask, 'background-color: #5CE488;', '') # Streamlit dark mode's green highlight
+                    with st.container(border=True):
+                        st.dataframe(df.style.apply(lambda _: styles, axis=None), use_container_width=True) # for the whole table
+                        st.page_link(page=tabs_lookups[tab_id_from_q].get('url'), label=tabs_lookups[tab_id_from_q].get('url'))
             else: st.warning(f"Table instance with ID `{tab_id_from_q}` cannot be presented.")
         elif modality == 'text' and ans.get('text_instances'):
             # Display the modality in bold
@@ -108,52 +255,207 @@ def display_evidence_card(question: str, ans: dict, turn_qid: str, card_index: i
                 if txt_id in txts_lookups:
                     txt_i = txts_lookups[txt_id]
                     # Display the text evidence with its title, content and URL
-                    with st.expander(label=f"Instance {i+1} from '{txt_i.get('title', '?')}'"):
-                        st.write(txt_i['text'])
-                        st.page_link(page=txt_i.get('url'), label=txt_i.get('url'))
+                    if st.toggle(f"Instance {i+1} from '{txt_i.get('title', '?')}'", key=f"open_{turn_qid}_{card_index}_{i}"):
+                        with st.container(border=True):
+                            st.write(txt_i['text'])
+                            st.page_link(page=txt_i.get('url'), label=txt_i.get('url'))
                 else: st.warning(f"Text instance with ID `{txt_id}` cannot be presented.")
         else:
             st.write("No specific evidence instances found for this answer.")
 
 # Load and cache the data to avoid reloading on every interaction
-@st.cache_data
+@st.cache_resource
 def cache_prepared() -> tuple:
-    """Cache all processed conversations & lookups."""
-    return prepare_all_data(QS_PATH, IMGS_JSONL_PATH, TABS_PATH, TXTS_PATH)
+    """Cache all processed conversations & lazy lookups as a shared 'resource' (no per-rerun copies of the lookups)."""
+    with metrics.stage('prepare_all_data'):
+        prepared = prepare_all_data(QS_PATH, IMGS_JSONL_PATH, TABS_PATH, TXTS_PATH)
+    for name, lookups in zip(['image', 'table', 'text'], prepared[1:4]):
+        metrics.register_cache(f"{name} records (LRU)", lambda lookups=lookups: lru_cache_stats(lookups))
+    return prepared
+
+@st.cache_resource(max_entries=128)
+def cache_table(tab_id: str) -> pd.DataFrame:
+    """Cache the most recently built table evidences by their ID, so that reruns skip rebuilding them.
+    Shared as a read-only 'resource' -- `st.cache_data` would copy the whole DataFrame on every hit."""
+    metrics.count('cache_table.misses') # only runs on cache misses
+    with metrics.stage('construct_table_from_lookups'):
+        return construct_table_from_lookups(tabs_lookups[tab_id]['table'])
+
+@st.cache_resource
+def clip_holder() -> dict:
+    """Process-wide holder of the lazily loaded CLIP model, shared by all sessions and the background warm-up."""
+    return {'lock': threading.Lock(), 'model': None, 'load_seconds': None}
+
+def load_clip_into(holder: dict) -> tuple:
+    """Load the CLIP model into the holder unless already loaded (safe to call from any thread)."""
+    with holder['lock']: # concurrent callers wait for the same load instead of loading twice
+        if holder['model'] is None:
+            start = time.perf_counter()
+            from clip_analyzer import load_clip
+            with metrics.stage('clip.load'):
+                holder['model'] = load_clip(**CLIP_SETTINGS)
+            holder['load_seconds'] = time.perf_counter() - start
+    return holder['model']
+
+def get_clip() -> tuple:
+    """Get the CLIP model and processor, loading them on first use."""
+    return load_clip_into(clip_holder())
+
+@st.cache_resource
+def warm_up_clip() -> threading.Thread:
+    """Start loading CLIP in a background thread once per process."""
+    holder = clip_holder()
+    def warm_up() -> None:
+        try:
+            load_clip_into(holder)
+        except Exception as e: # reported again by the first similarity request
+            print(f"Warning: Background loading of CLIP failed. Error: {e}")
+    thread = threading.Thread(target=warm_up, name="clip-warmup", daemon=True)
+    thread.start()
+    return thread
+
+def load_clip_embedding_store() -> tuple | None:
+    """Memory-map the precomputed image embeddings of the configured model (None if not built yet)."""
+    from clip_analyzer import CLIP_CHECKPOINT, model_tag
+    return load_embedding_store(EMBEDDINGS_DIR, model_tag(CLIP_SETTINGS.get('checkpoint', CLIP_CHECKPOINT), CLIP_SETTINGS['backend']))
 
 @st.cache_resource
-def cache_clip() -> tuple:
-    """Cache the CLIP model in Streamlit cache for 'resource' according to the documentation."""
-    return load_clip()
-
-try:
-    convs, imgs_lookups, tabs_lookups, txts_lookups = cache_prepared()
-    model, processor = cache_clip()
-except Exception as e:
-    st.error(f"Error loading data or model: {e}")
-    st.stop()
-
-# Sidebar for conversation selection
-st.sidebar.header("Conversation Selection")
-conv_ids = sorted(convs.keys())
-selected_conv_id = st.sidebar.selectbox("Choose a Conversation: ", conv_ids)
-selected_conv = convs[selected_conv_id]
-
-# Main Content Display
-if selected_conv_id:
-    # Store the conversation ID in session state for later access
-    st.session_state.current_conv = selected_conv
-    st.header(f"MMConvQA Exploring on Conversation `{selected_conv_id}`")
-    # For each turn/question in one conversation
-    for i, turn in enumerate(selected_conv):
-        # Store the turn state for later access
-        st.session_state.current_q = turn
-        with st.container(border=True):
-            st.markdown(f"## Turn {i+1}: `{turn['qid']}`")
-            # Display the current question for referencing
-            st.markdown(f"### Question: {turn['question']}")
-            # For each answer in one turn/question
-            for j, ans in enumerate(turn['answer']):
-                display_evidence_card(turn['question'], ans, turn['qid'], j)
-else:
-    st.header("MMConvQA Visualizer")
\ No newline at end of file
+def cache_embedding_store() -> tuple | None:
+    """Memory-map the precomputed image embeddings on first use (None if not built yet)."""
+    return load_clip_embedding_store()
+
+def text_embeddings():
+    """Question embeddings shared by all sessions and the CLIP job worker, seeded from the precomputed ones (`python embedding_store.py --questions`)."""
+    from clip_analyzer import CLIP_CHECKPOINT, model_tag, shared_text_cache
+    # A plain process-wide cache rather than `st.cache_resource`, as the job worker runs outside of any script run
+    cache = shared_text_cache(model_tag(CLIP_SETTINGS.get('checkpoint', CLIP_CHECKPOINT), CLIP_SETTINGS['backend']),
+                              cache_path=path.join(EMBEDDINGS_DIR, TEXT_CACHE_FILENAME))
+    metrics.register_cache("question embeddings", lambda: (cache.hits, cache.misses))
+    return cache
+
+@st.cache_resource
+def clip_job_queue() -> ClipJobQueue:
+    """Process-wide queue of CLIP similarity jobs, whose worker thread owns the model and batches the jobs of all sessions."""
+    holder = clip_holder()
+    # Only the worker loads the model, the embedding store and the text cache -- submitting stays free of torch & transformers
+    job_queue = ClipJobQueue(lambda: load_clip_into(holder), load_store=load_clip_embedding_store, load_txt_cache=text_embeddings, maxsize=CLIP_QUEUE_SIZE)
+    metrics.register_cache("CLIP jobs (coalesced)", lambda: (job_queue.stats['coalesced'], job_queue.stats['submitted']))
+    return job_queue
+
+@st.cache_resource
+def cache_search_index() -> tuple | None:
+    """Prepare the full image pool for retrieval: float32 embeddings in memory (fast exact search), row doc IDs, and the optional ANN index."""
+    store = cache_embedding_store()
+    if store is None:
+        return None
+    matrix, rows = store
+    ann_index = load_ann_index(EMBEDDINGS_DIR, matrix, RETRIEVAL_INDEX) if RETRIEVAL_INDEX != 'exact' else None
+    return np.asarray(matrix, dtype=np.float32), row_doc_ids(rows), ann_index
+
+_imports_seconds = time.perf_counter() - _START_TIME
+# The profiler is stopped and dumped even when the run ends early (`st.stop()`, reruns or errors)
+with profiled(METRICS_DIR, 'app_run') if _profile_requested else contextlib.nullcontext() as _profile_dump:
+    try:
+        convs, imgs_lookups, tabs_lookups, txts_lookups, nav_index = cache_prepared()
+    except Exception as e:
+        st.error(f"Error loading data: {e}")
+        st.stop()
+    # Missing evidence files only leave their evidences unresolved
+    missing_files = [path.basename(p) for p in (IMGS_JSONL_PATH, TABS_PATH, TXTS_PATH) if not path.exists(p)]
+    if missing_files:
+        st.warning(f"Evidence files not found in `{DATA_DIR}`: {', '.join(f'`{f}`' for f in missing_files)} -- their evidences cannot be presented.")
+    _data_seconds = time.perf_counter() - _START_TIME - _imports_seconds
+
+    # Sidebar for conversation selection
+    st.sidebar.header("Conversation Selection")
+    conv_ids = sorted(convs.keys())
+    # Filters are answered from the precomputed navigation index instead of scanning all turns on each rerun
+    with st.sidebar.expander("Filter Conversations"):
+        modalities = st.multiselect("With Answers of Modality", sorted(nav_index['modality_convs']),
+                                    help="Turns having an answer of any selected modality (and citing the selected evidence, if any) -- conversations with at least one such turn.")
+        evidence_query = st.text_input("Citing Evidence", placeholder="Title keywords or doc ID",
+                                       help="Turns citing the selected evidence (and having an answer of any selected modality, if any) -- conversations with at least one such turn. Evidence titles must contain all keywords.")
+        evidence_id = None
+        if evidence_query:
+            matches = search_evidences(nav_index, evidence_query)
+            if matches:
+                evidence_id = st.selectbox(f"Matching Evidences ({len(matches)})", matches,
+                                           format_func=lambda d: f"[{nav_index['docs'][d][0]}] {nav_index['docs'][d][1] or d}")
+            else:
+                st.caption("No cited evidence matches.")
+    # Both filters apply to the same turn, and a conversation matches if any of its turns does
+    matching_qids = None
+    if modalities or evidence_id is not None:
+        # Answers of one turn rarely span several modalities -- selected modalities are alternatives
+        postings = [{qid for modality in modalities for qid in nav_index['modality_turns'][modality]}] if modalities else []
+        if evidence_id is not None:
+            postings.append(set(nav_index['doc_turns'][evidence_id]))
+        matching_qids = set.intersection(*postings)
+        matching_convs = {nav_index['turn_positions'][qid][0] for qid in matching_qids}
+        conv_ids = [c for c in conv_ids if c in matching_convs]
+        st.sidebar.caption(f"{len(conv_ids)} of {len(convs)} conversations match.")
+    # Without any match, only the conversation body is skipped (the sidebar panels below still render)
+    selected_conv_id = st.sidebar.selectbox("Choose a Conversation: ", conv_ids) if conv_ids else None
+    if selected_conv_id:
+        selected_conv = convs[selected_conv_id]
+        # Only the turns of the current page are built on each rerun
+        turns_per_page = st.sidebar.select_slider("Turns per Page", options=[1, 2, 3, 5, 10, 20], value=5)
+        num_pages = max(1, -(-len(selected_conv) // turns_per_page)) # ceiling division
+        # Keyed by conversation so that switching conversations starts over from the first page
+        page = st.sidebar.number_input(f"Page (of {num_pages})", min_value=1, max_value=num_pages, value=1, key=f"page_{selected_conv_id}_{turns_per_page}")
+
+    # Main Content Display
+    if selected_conv_id:
+        st.header(f"MMConvQA Exploring on Conversation `{selected_conv_id}`")
+        # Get all image evidence instances in the entire conversation once for the similarity rankings
+        conv_img_ids = [inst['doc_id'] for turn in selected_conv for a in turn['answer'] if a.get('modality') == 'image' for inst in a.get('image_instances', [])]
+        # Reverse lookup of the turns matching the filters
+        if matching_qids is not None:
+            matching_turns = [f"Turn {nav_index['turn_positions'][qid][1] + 1} (`{qid}`)" for qid in sorted(matching_qids, key=lambda q: nav_index['turn_positions'][q][1])
+                              if nav_index['turn_positions'][qid][0] == selected_conv_id]
+            st.caption("Turns matching the filters: " + (", ".join(matching_turns) or "none"))
+        display_retrieval_panel(selected_conv, conv_img_ids)
+        # For each turn/question in the current page of the conversation
+        start = (page - 1) * turns_per_page
+        for i, turn in enumerate(selected_conv[start:start + turns_per_page], start=start):
+            with st.container(border=True):
+                st.markdown(f"## Turn {i+1}: `{turn['qid']}`")
+                # Display the current question for referencing
+                st.markdown(f"### Question: {turn['question']}")
+                # For each answer in one turn/question
+                for j, ans in enumerate(turn['answer']):
+                    display_evidence_card(turn, ans, j, conv_img_ids)
+    else:
+        st.header("MMConvQA Visualizer")
+        st.info("No conversation matches the filters -- adjust them in the sidebar.")
+
+    # The page is up -- only now (optionally) start loading CLIP
+    if CLIP_WARMUP:
+        warm_up_clip()
+    # Startup-phase timings of this run (the data step is near zero once cached)
+    with st.sidebar.expander("Startup Timings"):
+        st.caption(f"Imports: {_imports_seconds:.2f}s | Data: {_data_seconds:.2f}s | "
+                   f"Render: {time.perf_counter() - _START_TIME - _imports_seconds - _data_seconds:.2f}s")
+        load_seconds = clip_holder()['load_seconds']
+        st.caption(f"CLIP model: {'loaded in ' + format(load_seconds, '.2f') + 's' if load_seconds is not None else 'not loaded yet'}")
+    # Process-wide metrics of all sessions so far (fragment reruns are recorded too, but only shown on the next full run)
+    if metrics.enabled:
+        with st.sidebar.expander("Debug Metrics"):
+            snapshot = metrics.snapshot()
+            st.caption(f"Since {snapshot['uptime_s']:.0f}s | " + " | ".join(f"{k}: {v:.0f} MB" for k, v in snapshot['memory'].items()))
+            if snapshot['stages']:
+                st.dataframe(pd.DataFrame.from_dict(snapshot['stages'], orient='index').round(2), use_container_width=True)
+            if snapshot['caches']:
+                st.dataframe(pd.DataFrame.from_dict(snapshot['caches'], orient='index').round(3), use_container_width=True)
+            job_stats = clip_job_queue().stats
+            st.caption(f"CLIP jobs: {clip_job_queue().pending()} queued | {job_stats['completed']} completed | "
+                       f"{job_stats['failed']} failed | {job_stats['rejected']} rejected")
+            st.button("Profile Next Run", key="profile_next_run") # the flag is consumed on the next run
+            if st.button("Dump Flame Graph Stacks"):
+                stacks_path = metrics.dump_collapsed(path.join(METRICS_DIR, f"stacks_{time.strftime('%Y%m%d-%H%M%S')}.txt"))
+                st.caption(f"Written to `{stacks_path}`")
+            if st.button("Reset Metrics"):
+                metrics.reset()
+        metrics.log_snapshot()
+if _profile_dump is not None:
+    st.sidebar.caption(f"Profile of this run written to `{_profile_dump['path']}`")
@@ -0,0 +1,316 @@
+import os
+import gc
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+from os import path
+from PIL import Image
+
+from data_loader import load_data, load_lookups, prepare_all_data, construct_table_from_lookups
+
+
+# File names of the MMQA release, so that a generated data directory can also be served by the app
+QS_FILENAME = 'MMCoQA_dev.txt'
+IMGS_FILENAME = 'multimodalqa_final_dataset_pipeline_camera_ready_MMQA_images.jsonl'
+TABS_FILENAME = 'multimodalqa_final_dataset_pipeline_camera_ready_MMQA_tables.jsonl'
+TXTS_FILENAME = 'multimodalqa_final_dataset_pipeline_camera_ready_MMQA_texts.jsonl'
+IMG_FILES_DIRNAME = 'final_dataset_images'
+# Sizes of the synthetic dataset (the MMCoQA dev split has ~500 conversations of ~6 turns)
+SIZES = {
+    'small': dict(num_convs=50, turns_per_conv=6, num_images=100, num_tables=50, num_texts=300),
+    'medium': dict(num_convs=500, turns_per_conv=6, num_images=1000, num_tables=500, num_texts=3000),
+    'large': dict(num_convs=5000, turns_per_conv=6, num_images=10000, num_tables=5000, num_texts=30000),
+}
+WORDS = ['film', 'poster', 'building', 'player', 'team', 'album', 'city', 'river', 'season', 'award',
+         'singer', 'tower', 'logo', 'painting', 'bridge', 'car', 'flag', 'stadium', 'church', 'mountain']
+
+def generate_synthetic_mmqa(data_dir: str, num_convs: int = 50, turns_per_conv: int = 6, num_images: int = 100, num_tables: int = 50,
+                            num_texts: int = 300, table_shape: tuple[int, int] = (20, 6), image_size: tuple[int, int] = (320, 240),
+                            seed: int = 0) -> dict[str, str]:
+    """
+    Generate an MMQA-shaped dataset: a questions file referencing image, table and text evidences, the three evidence files,
+    and the image files themselves.
+
+    Args:
+        data_dir (str): Directory to write the dataset to.
+        num_convs (int): Number of conversations.
+        turns_per_conv (int): Number of turns per conversation.
+        num_images (int): Number of image evidences (and image files).
+        num_tables (int): Number of table evidences.
+        num_texts (int): Number of text evidences.
+        table_shape (tuple): (rows, columns) of every table.
+        image_size (tuple): (width, height) of every image.
+        seed (int): Seed of the generator, so that runs are comparable.
+
+    Returns:
+        paths (dict): Paths to the 'qs', 'imgs', 'tabs' and 'txts' files and to the 'img_files' directory.
+    """
+    rng = random.Random(seed)
+    sentence = lambda n: ' '.join(rng.choice(WORDS) for _ in range(n))
+    doc_id = lambda: '%032x' % rng.getrandbits(128) # shaped like the MMQA md5 doc IDs
+    paths = {'qs': path.join(data_dir, QS_FILENAME), 'imgs': path.join(data_dir, IMGS_FILENAME), 'tabs': path.join(data_dir, TABS_FILENAME),
+             'txts': path.join(data_dir, TXTS_FILENAME), 'img_files': path.join(data_dir, IMG_FILES_DIRNAME)}
+    os.makedirs(paths['img_files'], exist_ok=True)
+    # Evidences
+    img_ids = [doc_id() for _ in range(num_images)]
+    with open(paths['imgs'], 'w', encoding='utf-8') as file:
+        for i, img_id in enumerate(img_ids):
+            # Random noise compresses like real photos do, unlike flat colors
+            pixels = np.random.default_rng(seed + i).integers(0, 256, (image_size[1], image_size[0], 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(path.join(paths['img_files'], f"{img_id}.jpg"), quality=85)
+            file.write(json.dumps({'id': img_id, 'path': f"{img_id}.jpg", 'title': sentence(3), 'url': 'https://example.com'}) + '\n')
+    tab_ids = [doc_id() for _ in range(num_tables)]
+    with open(paths['tabs'], 'w', encoding='utf-8') as file:
+        for tab_id in tab_ids:
+            table = {'header': [{'column_name': rng.choice(WORDS)} for _ in range(table_shape[1])], # duplicated headers included
+                     'table_rows': [[{'text': sentence(2)} for _ in range(table_shape[1])] for _ in range(table_shape[0])]}
+            file.write(json.dumps({'id': tab_id, 'title': sentence(3), 'url': 'https://example.com', 'table': table}) + '\n')
+    txt_ids = [doc_id() for _ in range(num_texts)]
+    with open(paths['txts'], 'w', encoding='utf-8') as file:
+        for txt_id in txt_ids:
+            file.write(json.dumps({'id': txt_id, 'title': sentence(3), 'url': 'https://example.com', 'text': sentence(60)}) + '\n')
+    # Conversations, cycling through the answer modalities
+    with open(paths['qs'], 'w', encoding='utf-8') as file:
+        for c in range(num_convs):
+            table_id = rng.choice(tab_ids)
+            history = []
+            for t in range(turns_per_conv):
+                modality = ['image', 'table', 'text'][(c + t) % 3]
+                answer = {'answer': sentence(2), 'type': 'string', 'modality': modality,
+                          'text_instances': [], 'table_indices': [], 'image_instances': []}
+                if modality == 'image':
+                    answer['image_instances'] = [{'doc_id': d, 'doc_part': 'image'} for d in rng.sample(img_ids, rng.randint(1, min(2, num_images)))]
+                elif modality == 'table':
+                    answer['table_indices'] = [[rng.randrange(table_shape[0]), rng.randrange(table_shape[1])]]
+                else:
+                    answer['text_instances'] = [{'doc_id': rng.choice(txt_ids), 'doc_part': 'text'}]
+                question = sentence(12) + '?'
+                turn = {'qid': f"C_{c}_{t}", 'question': question, 'gold_question': question, 'answer': [answer],
+                        'question_type': modality, 'table_id': table_id, 'history': list(history)}
+                file.write(json.dumps(turn) + '\n')
+                history.append({'question': question, 'answer': [answer]})
+    return paths
+
+def tiny_clip(tokenizer_dir: str, image_size: int = 32, seed: int = 0):
+    """
+    Build a randomly-initialized CLIP with a few small layers, so that the scoring path can be benchmarked offline.
+    Its tokenizer has a byte-level vocabulary without merges, i.e., it splits texts into characters.
+
+    Args:
+        tokenizer_dir (str): Directory to write the tokenizer's vocabulary and merges files to.
+        image_size (int): Input resolution of the vision tower.
+        seed (int): Seed of the weights.
+
+    Returns:
+        tuple(CLIPModel, CLIPProcessor): The tiny CLIP model and processor.
+    """
+    import torch
+    from transformers import CLIPConfig, CLIPModel, CLIPProcessor, CLIPTokenizer, CLIPImageProcessor
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    os.makedirs(tokenizer_dir, exist_ok=True)
+    chars = list(bytes_to_unicode().values())
+    tokens = chars + [c + '</w>' for c in chars] + ['<|startoftext|>', '<|endoftext|>']
+    with open(path.join(tokenizer_dir, 'vocab.json'), 'w', encoding='utf-8') as file:
+        json.dump({token: i for i, token in enumerate(tokens)}, file)
+    with open(path.join(tokenizer_dir, 'merges.txt'), 'w', encoding='utf-8') as file:
+        file.write('#version: 0.2\n')
+    tokenizer = CLIPTokenizer(path.join(tokenizer_dir, 'vocab.json'), path.join(tokenizer_dir, 'merges.txt'), model_max_length=77)
+    image_processor = CLIPImageProcessor(size={'shortest_edge': image_size}, crop_size={'height': image_size, 'width': image_size})
+    config = CLIPConfig(
+        text_config=dict(vocab_size=len(tokens), hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=2, max_position_embeddings=77),
+        vision_config=dict(hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=2, image_size=image_size, patch_size=8),
+        projection_dim=32,
+    )
+    torch.manual_seed(seed)
+    return CLIPModel(config).eval(), CLIPProcessor(image_processor=image_processor, tokenizer=tokenizer)
+
+def measure(fn, repeat: int = 10, warmup: int = 1, items: int = 1, setup=None) -> dict[str, float]:
+    """
+    Time repeated calls of a function, then record its peak Python memory in one extra traced call.
+
+    Args:
+        fn (callable): Function to benchmark, called without arguments.
+        repeat (int): Number of timed calls.
+        warmup (int): Number of untimed calls before (e.g., to fill caches the stage relies on).
+        items (int): Number of items (turns, tables, pairs, ...) processed per call, for the throughput.
+        setup (callable | None): Called untimed before every call (e.g., to drop a cache the stage must not hit).
+
+    Returns:
+        stats (dict): Throughput in items/s, latency percentiles in ms, and peak traced memory in MB.
+        Tracing is kept out of the timed calls as it slows allocations down; it only sees Python allocations
+        (e.g., not the buffers of torch tensors).
+    """
+    for _ in range(warmup):
+        if setup:
+            setup()
+        fn()
+    latencies = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc.collect() # so that collections of earlier garbage do not land in the timings
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    if setup:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'calls': repeat,
+        'items_per_call': items,
+        'throughput': items * repeat / float(np.sum(latencies)),
+        'mean_ms': float(latencies_ms.mean()),
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p90_ms': float(np.percentile(latencies_ms, 90)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'max_ms': float(latencies_ms.max()),
+        'peak_mb': peak / 2**20,
+    }
+
+def run_benchmarks(paths: dict[str, str], model, processor, repeat: int = 10, stages: list[str] | None = None) -> dict[str, dict]:
+    """
+    Benchmark the data loading, table rendering and scoring hot paths on a dataset.
+
+    Args:
+        paths (dict): Dataset paths as returned by `generate_synthetic_mmqa`.
+        model (CLIPModel): CLIP model for the scoring stages (None skips them).
+        processor (CLIPProcessor): CLIP processor for the scoring stages.
+        repeat (int): Number of timed calls per stage.
+        stages (list | None): Names of the stages to run (all by default).
+
+    Returns:
+        results (dict): Statistics of `measure`, keyed by stage name.
+    """
+    results = {}
+    selected = lambda name: stages is None or name in stages
+    with open(paths['qs'], 'r', encoding='utf-8') as file:
+        num_turns = sum(1 for _ in file)
+    cache_dir = path.join(path.dirname(paths['qs']), '.cache')
+    data_args = (paths['qs'], paths['imgs'], paths['tabs'], paths['txts'])
+    quiet = lambda fn: lambda: _silenced(fn) # prepare_all_data reports its steps
+    if selected('load_data'):
+        results['load_data'] = measure(lambda: load_data(paths['qs']), repeat=repeat, items=num_turns)
+    if selected('prepare_all_data_cold'):
+        # Every call rebuilds the evidence indexes and the snapshot
+        def drop() -> None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            for evidence_path in data_args[1:]:
+                if path.exists(evidence_path + '.idx.json'):
+                    os.remove(evidence_path + '.idx.json')
+        results['prepare_all_data_cold'] = measure(quiet(lambda: prepare_all_data(*data_args)), repeat=repeat, items=num_turns, setup=drop)
+    if selected('prepare_all_data_warm'):
+        results['prepare_all_data_warm'] = measure(quiet(lambda: prepare_all_data(*data_args)), repeat=repeat, items=num_turns)
+    if selected('construct_table_from_lookups'):
+        # Parse the tables up front, so that only the DataFrame construction is measured
+        tables = [record['table'] for record in load_lookups(paths['tabs']).values()]
+        results['construct_table_from_lookups'] = measure(lambda: [construct_table_from_lookups(t) for t in tables], repeat=repeat, items=len(tables))
+    if model is not None:
+        from clip_analyzer import get_img_txt_similarity, get_img_txt_similarities
+
+        # The (question, image evidence) pairs of the dataset, as scored by the app and `scores_analyzer.py`
+        pairs = [(path.join(paths['img_files'], inst['doc_id'] + '.jpg'), turn['question'])
+                 for turn in load_data(paths['qs']) for a in turn['answer'] for inst in a['image_instances']][:64]
+        if selected('get_img_txt_similarity'):
+            results['get_img_txt_similarity'] = measure(lambda: [get_img_txt_similarity(p, q, model, processor) for p, q in pairs],
+                                                        repeat=repeat, items=len(pairs))
+        if selected('get_img_txt_similarities'):
+            # The batched counterpart, for reference
+            img_paths, questions = [p for p, _ in pairs], [q for _, q in pairs]
+            results['get_img_txt_similarities'] = measure(lambda: get_img_txt_similarities(img_paths, questions, model, processor),
+                                                          repeat=repeat, items=len(pairs))
+    return results
+
+def _silenced(fn):
+    """Call a function with its prints discarded."""
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            return fn()
+        finally:
+            sys.stdout = stdout
+
+def compare_results(baseline: dict, current: dict) -> list[str]:
+    """
+    Compare the stages of two benchmark runs.
+
+    Args:
+        baseline (dict): Earlier run, as written by this script.
+        current (dict): Current run.
+
+    Returns:
+        lines (list): One line per stage present in both runs, with the relative change of its p50 latency and throughput.
+    """
+    lines = []
+    for stage, stats in current['stages'].items():
+        base = baseline['stages'].get(stage)
+        if base is None:
+            continue
+        lines.append(f"{stage:<30} p50 {base['p50_ms']:9.2f} -> {stats['p50_ms']:9.2f} ms ({stats['p50_ms'] / base['p50_ms'] - 1:+.1%})   "
+                     f"throughput {base['throughput']:10.1f} -> {stats['throughput']:10.1f}/s ({stats['throughput'] / base['throughput'] - 1:+.1%})")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the loading, rendering and scoring hot paths on a synthetic MMQA-shaped dataset.")
+    parser.add_argument('--size', default='small', choices=list(SIZES), help="Size of the synthetic dataset.")
+    parser.add_argument('--data-dir', default=None, help="Where to generate the dataset (defaults to a temporary directory, deleted afterwards).")
+    parser.add_argument('--repeat', type=int, default=10, help="Number of timed calls per stage.")
+    parser.add_argument('--stages', nargs='+', default=None, help="Only run these stages.")
+    parser.add_argument('--checkpoint', default=None, help="Score with this CLIP checkpoint (or 'small'/'large') instead of the tiny random one (requires the download).")
+    parser.add_argument('--backend', default='fp32', help="CLIP inference backend of --checkpoint.")
+    parser.add_argument('--no-clip', action='store_true', help="Skip the scoring stages.")
+    parser.add_argument('--output', default=None, help="Write the results as JSON to this file.")
+    parser.add_argument('--compare', default=None, help="JSON results of an earlier run to compare against.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic dataset and the tiny model.")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='mmqa_bench_')
+    try:
+        print(f"Generating a {args.size} synthetic dataset in {data_dir}...")
+        paths = generate_synthetic_mmqa(data_dir, seed=args.seed, **SIZES[args.size])
+        model = processor = None
+        if not args.no_clip:
+            if args.checkpoint:
+                from clip_analyzer import load_clip, resolve_checkpoint
+                args.checkpoint = resolve_checkpoint(args.checkpoint) # record the full name in the results
+                model, processor = load_clip(args.checkpoint, backend=args.backend)
+            else:
+                model, processor = tiny_clip(path.join(data_dir, 'tiny_clip'), seed=args.seed)
+        stages = run_benchmarks(paths, model, processor, repeat=args.repeat, stages=args.stages)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    results = {
+        'config': {'size': args.size, **SIZES[args.size], 'repeat': args.repeat, 'seed': args.seed,
+                   'clip': None if args.no_clip else (args.checkpoint and f"{args.checkpoint}@{args.backend}") or 'tiny-random'},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                        'numpy': np.__version__, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'stages': stages,
+    }
+    print(f"\n{'Stage':<30} {'Throughput':>14} {'p50 (ms)':>10} {'p90 (ms)':>10} {'p99 (ms)':>10} {'Peak (MB)':>10}")
+    for stage, stats in stages.items():
+        print(f"{stage:<30} {stats['throughput']:12.1f}/s {stats['p50_ms']:10.2f} {stats['p90_ms']:10.2f} {stats['p99_ms']:10.2f} {stats['peak_mb']:10.2f}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(f"\nResults written to {args.output}.")
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        print(f"\nComparison against {args.compare}:")
+        print('\n'.join(compare_results(baseline, results)))
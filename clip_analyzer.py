@@ -1,22 +1,132 @@
+import os
+import hashlib
+import threading
 import torch
-from transformers import CLIPProcessor, CLIPModel
-from PIL import Image
+import numpy as np
+from os import path
+from transformers import CLIPConfig, CLIPProcessor, CLIPModel
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+from image_cache import preprocess_img, get_pixel_values
 
-def load_clip() -> tuple[CLIPModel, CLIPProcessor]:
+
+# Default checkpoint, also used to key the precomputed embedding store
+CLIP_CHECKPOINT = "openai/clip-vit-large-patch14"
+# Roughly 4x faster on CPU at a cost in accuracy
+SMALL_CLIP_CHECKPOINT = "openai/clip-vit-base-patch32"
+# Short names accepted wherever a checkpoint is (e.g., `--checkpoint small`, `CLIP_CHECKPOINT=small`)
+CLIP_CHECKPOINT_ALIASES = {'large': CLIP_CHECKPOINT, 'small': SMALL_CLIP_CHECKPOINT}
+# 'fp32': eager PyTorch baseline, 'bf16': bfloat16 weights, 'int8': dynamically quantized linear layers, 'onnx': ONNX Runtime
+CLIP_BACKENDS = ('fp32', 'bf16', 'int8', 'onnx')
+
+class OnnxCLIPModel:
+    """
+    Drop-in replacement for `CLIPModel` in this module, running the exported image and text towers with ONNX Runtime.
+
+    Args:
+        onnx_dir (str): Directory holding 'image.onnx' and 'text.onnx' (see `export_clip_onnx`).
+        config (CLIPConfig): Config of the exported model.
+        num_threads (int | None): Intra-op threads of each inference session (None for ONNX Runtime's default).
+    """
+    def __init__(self, onnx_dir: str, config, num_threads: int | None = None):
+        import onnxruntime as ort # optional dependency, only needed for this backend
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.config = config
+        self.device = torch.device('cpu')
+        self.dtype = torch.float32
+        self.image_session = ort.InferenceSession(path.join(onnx_dir, 'image.onnx'), options, providers=['CPUExecutionProvider'])
+        self.text_session = ort.InferenceSession(path.join(onnx_dir, 'text.onnx'), options, providers=['CPUExecutionProvider'])
+
+    def get_image_features(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return torch.from_numpy(self.image_session.run(None, {'pixel_values': pixel_values.numpy()})[0])
+
+    def get_text_features(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        feeds = {'input_ids': input_ids.numpy().astype(np.int64), 'attention_mask': attention_mask.numpy().astype(np.int64)}
+        return torch.from_numpy(self.text_session.run(None, feeds)[0])
+
+def export_clip_onnx(model: CLIPModel, onnx_dir: str) -> None:
+    """
+    Export the image and text towers (including their projections) of a CLIP model to ONNX.
+
+    Args:
+        model (CLIPModel): Pretrained fp32 CLIP model.
+        onnx_dir (str): Directory to write 'image.onnx' and 'text.onnx' to.
+    """
+    class ImageTower(torch.nn.Module):
+        def __init__(self, clip):
+            super().__init__()
+            self.clip = clip
+        def forward(self, pixel_values):
+            return self.clip.get_image_features(pixel_values=pixel_values)
+
+    class TextTower(torch.nn.Module):
+        def __init__(self, clip):
+            super().__init__()
+            self.clip = clip
+        def forward(self, input_ids, attention_mask):
+            return self.clip.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+    os.makedirs(onnx_dir, exist_ok=True)
+    image_size = model.config.vision_config.image_size
+    dummy_pixels = torch.zeros(1, 3, image_size, image_size)
+    dummy_ids = torch.ones(1, 8, dtype=torch.long)
+    with torch.no_grad():
+        torch.onnx.export(ImageTower(model).eval(), (dummy_pixels,), path.join(onnx_dir, 'image.onnx'),
+                          input_names=['pixel_values'], output_names=['image_embeds'],
+                          dynamic_axes={'pixel_values': {0: 'batch'}, 'image_embeds': {0: 'batch'}}, dynamo=False)
+        torch.onnx.export(TextTower(model).eval(), (dummy_ids, torch.ones_like(dummy_ids)), path.join(onnx_dir, 'text.onnx'),
+                          input_names=['input_ids', 'attention_mask'], output_names=['text_embeds'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'},
+                                        'text_embeds': {0: 'batch'}}, dynamo=False)
+
+def resolve_checkpoint(checkpoint: str) -> str:
+    """Expand a checkpoint alias of `CLIP_CHECKPOINT_ALIASES` to its Hugging Face name (other names are returned as is)."""
+    return CLIP_CHECKPOINT_ALIASES.get(checkpoint, checkpoint)
+
+def model_tag(checkpoint: str, backend: str = 'fp32') -> str:
+    """Identify the embeddings produced by a checkpoint & backend (e.g., to key the precomputed embedding store)."""
+    checkpoint = resolve_checkpoint(checkpoint)
+    return checkpoint if backend == 'fp32' else f"{checkpoint}@{backend}"
+
+def load_clip(checkpoint: str = CLIP_CHECKPOINT, backend: str = 'fp32', num_threads: int | None = None,
+              onnx_dir: str | None = None) -> tuple[CLIPModel, CLIPProcessor]:
     """
     Load the CLIP model and processor.
 
     Args:
-        None
+        checkpoint (str): Hugging Face checkpoint name of the CLIP model, or one of `CLIP_CHECKPOINT_ALIASES`.
+        backend (str): Inference backend, one of `CLIP_BACKENDS`.
+        num_threads (int | None): Intra-op threads for inference (None keeps the library defaults, i.e., all cores).
+        onnx_dir (str | None): Where the ONNX export is cached for the 'onnx' backend (defaults to './data/onnx/<checkpoint>').
     
     Returns:
         tuple(CLIPModel, CLIPProcessor): The CLIP model and processor.
     """
-    print("Loading CLIP model and processor...")
-    checkpoint = "openai/clip-vit-large-patch14"
-    model = CLIPModel.from_pretrained(checkpoint)
+    if backend not in CLIP_BACKENDS:
+        raise ValueError(f"Unknown CLIP backend '{backend}' -- expected one of {CLIP_BACKENDS}")
+    checkpoint = resolve_checkpoint(checkpoint)
+    print(f"Loading CLIP model and processor ({checkpoint}, {backend})...")
+    # Limit the threads of shared hosts where several processes run inference
+    if num_threads:
+        torch.set_num_threads(num_threads)
     processor = CLIPProcessor.from_pretrained(checkpoint, use_fast=False) # '_valid_processor_keys'
+    if backend == 'onnx':
+        onnx_dir = onnx_dir or path.join('./data/onnx', checkpoint.replace('/', '__'))
+        if not (path.exists(path.join(onnx_dir, 'image.onnx')) and path.exists(path.join(onnx_dir, 'text.onnx'))):
+            # The PyTorch weights are only loaded once, to export them
+            print(f"Exporting CLIP to ONNX in {onnx_dir}...")
+            export_clip_onnx(CLIPModel.from_pretrained(checkpoint).eval(), onnx_dir)
+        return OnnxCLIPModel(onnx_dir, CLIPConfig.from_pretrained(checkpoint), num_threads=num_threads), processor
+    model = CLIPModel.from_pretrained(checkpoint).eval()
+    if backend == 'bf16':
+        model = model.to(torch.bfloat16)
+    elif backend == 'int8':
+        # Weights of the linear layers (the bulk of the transformer) are stored in int8, activations quantized on the fly
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
     return model, processor
 
 def get_img_txt_similarity(img_path: str, text: str, model: CLIPModel, processor: CLIPProcessor) -> float:
@@ -30,39 +140,324 @@ def get_img_txt_similarity(img_path: str, text: str, model: CLIPModel, processor
         processor (CLIPProcessor): Pretrained CLIP processor.
 
     Returns:
-        similarity (float): Cosine similarity score between the image and text.
-    """
-    try:
-        img = Image.open(img_path)
-    except Exception as e:
-        print(f"Warning: Could not open image {img_path}. Error: {e}")
-
-        return 0.0
-    # Encode both text and image with the wrapped encoders
-    inputs = processor(text=[text], images=img, return_tensors="pt", padding=True) # no computation -> no necessity to move to GPU
-    # Move inputs to the same device as the model (as the model is moved to GPU if available)
-    inputs = {k: v.to(model.device) for k, v in inputs.items()} # keys are 'input_ids', 'attention_mask', 'pixel_values'
-    # Disable gradient calculation for inference for efficiency
-    with torch.no_grad(): 
-        outputs = model(**inputs) # Output keys: ['logits_per_image', 'logits_per_text', 'text_embeds', 'image_embeds', 'text_model_output', 'vision_model_output'] 
-    # logits <==> similarity * exp, last_hidden_state <==> prior to NN head, pooler_output <==> after one linear layer (pooling), 
-    # Utilize the embeddings for similarity calculation
-    img_embeds = outputs.image_embeds
-    text_embeds = outputs.text_embeds
-    # Normalize (along the dimension of each vector's elements) embeddings for accurate cosine similarity
-    normed_img_embed = img_embeds / img_embeds.norm(dim=-1, keepdim=True) # compute Euclidean norm for each vector
-    normed_txt_embed = text_embeds / text_embeds.norm(dim=-1, keepdim=True) # make sure the dimensions/shape are the same
-    # Calculate similarity using matrix multiplication (i.e., dot product of normalized vectors <==> cosine similarity)
-    similarity = (normed_txt_embed @ normed_img_embed.T).item() # extract the scalar values from the tensors
-    
-    return similarity
+        similarity (float): Cosine similarity score between the image and text (0.0 if the image could not be opened).
+    """
+    similarity = get_img_txt_similarities([img_path], [text], model, processor)[0, 0]
+    return 0.0 if np.isnan(similarity) else float(similarity)
+
+def encode_pixel_values(pixel_values: torch.Tensor, model: CLIPModel) -> np.ndarray:
+    """
+    Encodes a batch of pre-processed images into L2-normalized CLIP embeddings.
+
+    Args:
+        pixel_values (torch.Tensor): Tensor of shape (B, 3, H, W).
+        model (CLIPModel): Pretrained CLIP model (of any backend).
+
+    Returns:
+        embeddings (np.ndarray): Float32 array of shape (B, D).
+    """
+    # Move inputs to the same device (and precision) as the model
+    pixel_values = pixel_values.to(model.device, dtype=model.dtype)
+    with torch.no_grad():
+        img_embeds = model.get_image_features(pixel_values=pixel_values)
+    # Normalize so that the dot product of two embeddings is their cosine similarity
+    img_embeds = img_embeds / img_embeds.norm(dim=-1, keepdim=True)
+    return img_embeds.cpu().float().numpy()
+
+def get_img_embeddings(img_paths: list[str], model: CLIPModel, processor: CLIPProcessor, batch_size: int = 16, num_workers: int = 4,
+                       use_cache: bool = False) -> np.ndarray:
+    """
+    Encodes images into L2-normalized CLIP embeddings, decoding the next batch in a thread pool while the current one is encoded.
+
+    Args:
+        img_paths (list): Paths to the image files.
+        model (CLIPModel): Pretrained CLIP model.
+        processor (CLIPProcessor): Pretrained CLIP processor.
+        batch_size (int): Number of images encoded per forward pass.
+        num_workers (int): Number of threads decoding & pre-processing images.
+        use_cache (bool): Whether to reuse pre-processed images from the in-process LRU (see `image_cache.get_pixel_values`).
+
+    Returns:
+        embeddings (np.ndarray): Float32 array of shape (N, D), with NaN rows for images that could not be opened.
+    """
+    embeddings = np.full((len(img_paths), model.config.projection_dim), np.nan, dtype=np.float32)
+    batch_starts = range(0, len(img_paths), batch_size)
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        def submit(start: int) -> list:
+            preprocess = get_pixel_values if use_cache else preprocess_img
+            return [pool.submit(preprocess, p, processor) for p in img_paths[start:start + batch_size]]
+        # Only one batch is prefetched at a time to keep the memory of decoded images bounded
+        pending = submit(0) if img_paths else []
+        for start in batch_starts:
+            pixel_values = [future.result() for future in pending]
+            pending = submit(start + batch_size) if start + batch_size < len(img_paths) else []
+            # Remember the positions of the images as some may fail to load
+            positions = [start + i for i, pv in enumerate(pixel_values) if pv is not None]
+            if not positions:
+                continue
+            embeddings[positions] = encode_pixel_values(torch.stack([pv for pv in pixel_values if pv is not None]), model)
+    return embeddings
+
+def text_key(text: str) -> str:
+    """
+    Key of a text for caching its embedding: CLIP's tokenizer lower-cases and collapses whitespace anyway,
+    so texts differing only therein share one embedding.
+
+    Args:
+        text (str): Text to key.
+
+    Returns:
+        key (str): Hex digest of the normalized text.
+    """
+    return hashlib.blake2b(' '.join(text.split()).lower().encode('utf-8'), digest_size=16).hexdigest()
+
+class TextEmbeddingCache:
+    """
+    Bounded, thread-safe LRU of text embeddings keyed by `text_key`, optionally persisted to an .npz file.
+
+    Args:
+        tag (str): Model the embeddings were computed with (see `model_tag`) -- persisted caches of other models are ignored.
+        maxsize (int): Maximum number of embeddings kept (~3KB each for ViT-L/14).
+        cache_path (str | None): .npz file to load the cache from and save it to.
+    """
+    def __init__(self, tag: str, maxsize: int = 16384, cache_path: str | None = None):
+        self.tag = tag
+        self.maxsize = maxsize
+        self.cache_path = cache_path
+        self.hits = self.misses = 0
+        self._embeds = OrderedDict() # least recently used first
+        self._lock = threading.Lock() # shared by all Streamlit sessions
+        if cache_path and path.exists(cache_path):
+            try:
+                with np.load(cache_path) as persisted:
+                    if str(persisted['tag']) == tag:
+                        self.put_many(list(persisted['keys']), persisted['embeddings'])
+            except Exception as e:
+                print(f"Warning: Could not load text embedding cache from {cache_path}. Error: {e}")
+
+    def __len__(self) -> int:
+        return len(self._embeds)
+
+    def get_many(self, keys: list[str]) -> dict[str, np.ndarray]:
+        """Get the cached embeddings of the given keys (misses are left out)."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._embeds:
+                    self._embeds.move_to_end(key)
+                    found[key] = self._embeds[key]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, keys: list[str], embeddings: np.ndarray) -> None:
+        """Cache the embeddings of the given keys, evicting the least recently used ones beyond `maxsize`."""
+        with self._lock:
+            for key, embed in zip(keys, embeddings):
+                self._embeds[key] = np.asarray(embed, dtype=np.float32)
+                self._embeds.move_to_end(key)
+            while len(self._embeds) > self.maxsize:
+                self._embeds.popitem(last=False)
+
+    def save(self, cache_path: str | None = None) -> None:
+        """Persist the cache to an .npz file (defaults to the one it was loaded from)."""
+        cache_path = cache_path or self.cache_path
+        with self._lock:
+            keys = list(self._embeds)
+            embeddings = np.stack(list(self._embeds.values())) if keys else np.empty((0, 0), dtype=np.float32)
+        os.makedirs(path.dirname(cache_path) or '.', exist_ok=True)
+        tmp_path = cache_path + '.tmp.npz' # np.savez appends '.npz' to other extensions
+        np.savez(tmp_path, tag=self.tag, keys=np.array(keys), embeddings=embeddings)
+        os.replace(tmp_path, cache_path)
+
+# Text embedding caches shared process-wide, see `shared_text_cache`
+_shared_text_caches = {}
+_shared_text_caches_lock = threading.Lock()
+
+def shared_text_cache(tag: str, cache_path: str | None = None) -> TextEmbeddingCache:
+    """
+    Get the process-wide text embedding cache of a model, creating it on first call -- usable from any thread
+    (e.g., background workers, which cannot use Streamlit's caches).
+
+    Args:
+        tag (str): Model the embeddings are computed with (see `model_tag`).
+        cache_path (str | None): .npz file to load the cache from and save it to.
+
+    Returns:
+        cache (TextEmbeddingCache): The same cache for the same arguments.
+    """
+    with _shared_text_caches_lock:
+        if (tag, cache_path) not in _shared_text_caches:
+            _shared_text_caches[tag, cache_path] = TextEmbeddingCache(tag, cache_path=cache_path)
+        return _shared_text_caches[tag, cache_path]
+
+def get_txt_embeddings(texts: list[str], model: CLIPModel, processor: CLIPProcessor, batch_size: int = 64,
+                       cache: TextEmbeddingCache | None = None) -> np.ndarray:
+    """
+    Encodes texts into L2-normalized CLIP embeddings, running the text tower once per distinct (normalized) text.
+
+    Args:
+        texts (list): Texts to encode.
+        model (CLIPModel): Pretrained CLIP model.
+        processor (CLIPProcessor): Pretrained CLIP processor.
+        batch_size (int): Number of texts encoded per forward pass.
+        cache (TextEmbeddingCache | None): Cache to reuse embeddings from and add new ones to (must match the model).
+
+    Returns:
+        embeddings (np.ndarray): Float32 array of shape (M, D), aligned with `texts`.
+    """
+    keys = [text_key(text) for text in texts]
+    distinct = dict(zip(keys, texts)) # key -> first text with that key
+    embeds = cache.get_many(list(distinct)) if cache is not None else {}
+    to_encode = [key for key in distinct if key not in embeds]
+    for start in range(0, len(to_encode), batch_size):
+        batch_keys = to_encode[start:start + batch_size]
+        inputs = processor(text=[distinct[key] for key in batch_keys], return_tensors="pt", padding=True, truncation=True) # CLIP's text tower is capped at 77 tokens
+        inputs = {k: v.to(model.device) for k, v in inputs.items()} # keys are 'input_ids', 'attention_mask'
+        with torch.no_grad():
+            txt_embeds = model.get_text_features(**inputs)
+        txt_embeds = (txt_embeds / txt_embeds.norm(dim=-1, keepdim=True)).cpu().float().numpy()
+        embeds.update(zip(batch_keys, txt_embeds))
+        if cache is not None:
+            cache.put_many(batch_keys, txt_embeds)
+    # Scatter the embeddings back to the (possibly repeated) input texts
+    if not texts:
+        return np.empty((0, model.config.projection_dim), dtype=np.float32)
+    return np.stack([embeds[key] for key in keys])
+
+def get_img_txt_similarities(img_paths: list[str], texts: list[str], model: CLIPModel, processor: CLIPProcessor,
+                             batch_size: int = 16, num_workers: int = 4) -> np.ndarray:
+    """
+    Calculates cosine similarities between N images and M texts in batches.
+
+    Args:
+        img_paths (list): Paths to the N image files.
+        texts (list): M texts to compare with the images.
+        model (CLIPModel): Pretrained CLIP model.
+        processor (CLIPProcessor): Pretrained CLIP processor.
+        batch_size (int): Number of images encoded per forward pass.
+        num_workers (int): Number of threads decoding & pre-processing images.
+
+    Returns:
+        similarities (np.ndarray): Array of shape (N, M), with NaN rows for images that could not be opened.
+    """
+    img_embeds = get_img_embeddings(img_paths, model, processor, batch_size=batch_size, num_workers=num_workers)
+    txt_embeds = get_txt_embeddings(texts, model, processor)
+    return img_embeds @ txt_embeds.T
+
+def search_images(query_embeds: np.ndarray, matrix: np.ndarray, k: int = 10, candidate_rows: np.ndarray | None = None,
+                  ann_index=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the top-k images by cosine similarity to each query, either exactly with NumPy or approximately with a faiss index.
+
+    Args:
+        query_embeds (np.ndarray): Normalized query embeddings of shape (Q, D).
+        matrix (np.ndarray): Normalized image embeddings of shape (N, D) -- keep it as float32 in memory for fast exact search.
+        k (int): Number of images to return per query.
+        candidate_rows (np.ndarray | None): Restrict the search to these rows of the matrix (e.g., one conversation's images).
+        ann_index (faiss.Index | None): Approximate index over the full matrix (ignored when `candidate_rows` is given).
+
+    Returns:
+        tuple(np.ndarray, np.ndarray): Scores and matrix rows of the top-k images, both of shape (Q, min(k, N)), best first.
+    """
+    query_embeds = np.atleast_2d(query_embeds).astype(np.float32)
+    if ann_index is not None and candidate_rows is None:
+        scores, rows = ann_index.search(query_embeds, min(k, matrix.shape[0]))
+        return scores, rows
+    candidates = matrix if candidate_rows is None else matrix[candidate_rows]
+    k = min(k, candidates.shape[0])
+    if k == 0:
+        return np.empty((len(query_embeds), 0), dtype=np.float32), np.empty((len(query_embeds), 0), dtype=np.int64)
+    scores = query_embeds @ np.asarray(candidates, dtype=np.float32).T # (Q, N)
+    # Partial selection of the top-k (O(N)) before sorting only those k
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    top, top_scores = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+    rows = top if candidate_rows is None else np.asarray(candidate_rows)[top]
+    return top_scores, rows
+
+def retrieve_images(text: str, model: CLIPModel, processor: CLIPProcessor, matrix: np.ndarray, doc_ids: list[str], k: int = 10,
+                    candidate_rows: np.ndarray | None = None, ann_index=None, cache: TextEmbeddingCache | None = None) -> list[tuple[str, float]]:
+    """
+    Retrieves the top-k images of an embedding store for a text (e.g., a question).
+
+    Args:
+        text (str): Query text.
+        model (CLIPModel): Pretrained CLIP model.
+        processor (CLIPProcessor): Pretrained CLIP processor.
+        matrix (np.ndarray): Normalized image embeddings of shape (N, D).
+        doc_ids (list): Doc ID of each row of the matrix.
+        k (int): Number of images to return.
+        candidate_rows (np.ndarray | None): Restrict the search to these rows of the matrix.
+        ann_index (faiss.Index | None): Approximate index over the full matrix.
+        cache (TextEmbeddingCache | None): Cache of text embeddings matching the model.
+
+    Returns:
+        results (list): (doc_id, score) of the top-k images, best first.
+    """
+    query_embed = get_txt_embeddings([text], model, processor, cache=cache)
+    scores, rows = search_images(query_embed, matrix, k, candidate_rows=candidate_rows, ann_index=ann_index)
+    # faiss pads missing results with -1
+    return [(doc_ids[row], float(score)) for score, row in zip(scores[0], rows[0]) if row >= 0]
+
+def recall_at_k(retrieved_ids: list[str], gold_ids: list[str]) -> float:
+    """
+    Share of the gold images found among the retrieved ones.
+
+    Args:
+        retrieved_ids (list): Doc IDs of the retrieved images.
+        gold_ids (list): Doc IDs of the gold images (e.g., the answers' `image_instances`).
+
+    Returns:
+        recall (float): Recall in [0, 1] (NaN without gold images).
+    """
+    gold = set(gold_ids)
+    return len(gold & set(retrieved_ids)) / len(gold) if gold else float('nan')
+
+def compare_backends(img_paths: list[str], texts: list[str], baseline: tuple, candidate: tuple) -> dict[str, float]:
+    """
+    Measures how closely a candidate backend reproduces the similarity scores of a baseline (e.g., fp32) backend.
+
+    Args:
+        img_paths (list): Paths to the image files to score.
+        texts (list): Texts to score against every image.
+        baseline (tuple): (model, processor) of the reference backend.
+        candidate (tuple): (model, processor) of the backend to verify.
+
+    Returns:
+        agreement (dict): Maximum & mean absolute score difference, and the share of texts whose top-ranked image is unchanged.
+    """
+    expected = get_img_txt_similarities(img_paths, texts, *baseline)
+    actual = get_img_txt_similarities(img_paths, texts, *candidate)
+    # Images that could not be opened are NaN for both backends
+    valid = ~np.isnan(expected).any(axis=1)
+    expected, actual = expected[valid], actual[valid]
+    diff = np.abs(expected - actual)
+    return {'max_abs_diff': float(diff.max()) if diff.size else 0.0,
+            'mean_abs_diff': float(diff.mean()) if diff.size else 0.0,
+            'top1_agreement': float((expected.argmax(axis=0) == actual.argmax(axis=0)).mean()) if diff.size else 1.0}
 
 
 if __name__ == "__main__":
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Test the loading and similarity calculation of a CLIP backend.")
+    parser.add_argument('--checkpoint', default=CLIP_CHECKPOINT, help="CLIP checkpoint to load.")
+    parser.add_argument('--backend', default='fp32', choices=CLIP_BACKENDS, help="Inference backend.")
+    parser.add_argument('--num-threads', type=int, default=None, help="Intra-op threads for inference.")
+    parser.add_argument('--verify', nargs='*', metavar='IMAGE', help="Compare the backend's scores against fp32 on the given images (or the demo image).")
+    args = parser.parse_args()
+
     # Test the Loading and similarity calculation
     img_path = r'.\data\final_dataset_images' + r"\f60afcdec9238132fc0f6d11e54c6457" + '.jpg'
     question = "Which Syncopy Inc. movie title(s) that has/have a tall building in the background of its poster?"
-    model, processor = load_clip()
+    model, processor = load_clip(args.checkpoint, backend=args.backend, num_threads=args.num_threads)
     # Get similarity score
+    start = time.perf_counter()
     score = get_img_txt_similarity(img_path=img_path, text=question, model=model, processor=processor)
-    print(f"Similarity Score: {score}")
\ No newline at end of file
+    print(f"Similarity Score: {score} ({time.perf_counter() - start:.3f}s)")
+    if args.verify is not None and args.backend != 'fp32':
+        agreement = compare_backends(args.verify or [img_path], [question], load_clip(args.checkpoint), (model, processor))
+        print(f"Agreement with fp32: {agreement}")
@@ -1,5 +1,15 @@
+import os
+import re
 import json
+import pickle
+import hashlib
+import tempfile
+import threading
+import functools
+import numpy as np
 import pandas as pd
+from os import path
+from collections.abc import Mapping
 
 
 def load_data(file_path: str) -> list[dict]:
@@ -14,7 +24,7 @@ def load_data(file_path: str) -> list[dict]:
     """
     try:
         with open(file_path, 'r', encoding='utf-8') as file: # 'utf-8' for handling jsonl files
-            data = [json.loads(line) for line in file.readlines()]
+            data = [json.loads(line) for line in file if line.strip()] # stream the lines instead of reading the whole file first
         return data
     except Exception as e:
         print(f"Error loading data from {file_path}: {e}")
@@ -33,10 +43,8 @@ def group_by_conversation(q_data: list[dict]) -> dict[str, list[dict]]:
     conversations = {}
     for q in q_data:
         # According to the qid, the first two sections appear to be the conversation ID
-        conv_id = q['qid'].split('_')[0] + '_' + q['qid'].split('_')[1] # e.g., "C_381_1" -> "C_381"
-        if conv_id not in conversations:
-            conversations[conv_id] = []
-        conversations[conv_id].append(q)        
+        conv_id = '_'.join(q['qid'].split('_', 2)[:2]) # e.g., "C_381_1" -> "C_381", splitting the qid only once
+        conversations.setdefault(conv_id, []).append(q)
     return conversations
 
 def construct_lookups(evidence_data: list[dict]) -> dict[str, dict]:
@@ -51,6 +59,162 @@ def construct_lookups(evidence_data: list[dict]) -> dict[str, dict]:
     """
     return {item['id']: item for item in evidence_data}
 
+def file_fingerprint(file_path: str) -> str | None:
+    """
+    Cheap fingerprint of a file used to detect whether data derived from it went stale.
+
+    Args:
+        file_path (str): Path to the file.
+
+    Returns:
+        fingerprint (str | None): "<size>-<mtime_ns>" of the file, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+def atomic_write(file_path: str, write, binary: bool = False) -> None:
+    """
+    Write a file through a unique temporary file in the same directory, so that concurrent writers (threads or
+    processes) never replace it with a partially written one.
+
+    Args:
+        file_path (str): File to (re-)place.
+        write (callable): Writes the content to the open temporary file.
+        binary (bool): Whether to open the temporary file in binary mode.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=path.basename(file_path) + '.', dir=path.dirname(file_path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') if binary else os.fdopen(fd, 'w', encoding='utf-8') as file:
+            write(file)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def build_jsonl_index(file_path: str, key: str = 'id') -> dict[str, tuple[int, int]]:
+    """
+    Scan a JSONL file once and record where each record is stored.
+
+    Args:
+        file_path (str): Path to the JSONL file.
+        key (str): Field holding each record's ID.
+
+    Returns:
+        index (dict): Mapping from record IDs to their (byte offset, byte length) in the file.
+    """
+    index = {}
+    offset = 0
+    with open(file_path, 'rb') as file: # binary mode so that offsets are exact byte positions
+        for line in file:
+            if line.strip():
+                index[json.loads(line)[key]] = (offset, len(line))
+            offset += len(line)
+    return index
+
+def load_jsonl_index(file_path: str, key: str = 'id') -> dict[str, tuple[int, int]]:
+    """
+    Load the byte-offset index persisted beside a JSONL file, (re-)building it if missing or stale.
+
+    Args:
+        file_path (str): Path to the JSONL file.
+        key (str): Field holding each record's ID.
+
+    Returns:
+        index (dict): Mapping from record IDs to their (byte offset, byte length) in the file (empty if the file is missing).
+    """
+    index_path = file_path + '.idx.json'
+    fingerprint = file_fingerprint(file_path)
+    # In case the evidence file is not downloaded -- its evidences are then reported as not found
+    if fingerprint is None:
+        print(f"Warning: Evidence file {file_path} not found -- continuing without its evidences.")
+        return {}
+    try:
+        with open(index_path, 'r', encoding='utf-8') as file:
+            persisted = json.load(file)
+        if persisted.get('source') == fingerprint and persisted.get('key') == key:
+            return {doc_id: tuple(entry) for doc_id, entry in persisted['index'].items()}
+    except (OSError, ValueError, KeyError):
+        pass # missing or corrupted -- rebuild below
+    print(f"Indexing {file_path}...")
+    index = build_jsonl_index(file_path, key)
+    try:
+        atomic_write(index_path, lambda file: json.dump({'source': fingerprint, 'key': key, 'index': index}, file))
+    except OSError as e:
+        print(f"Warning: Could not persist index to {index_path}. Error: {e}")
+    return index
+
+class LazyJsonlLookup(Mapping):
+    """
+    Read-only doc_id -> record mapping over a JSONL file that only parses the records actually accessed.
+
+    Args:
+        file_path (str): Path to the JSONL file.
+        index (dict): Mapping from record IDs to their (byte offset, byte length), see `load_jsonl_index`.
+        cache_size (int): Number of recently parsed records kept in memory.
+    """
+    def __init__(self, file_path: str, index: dict[str, tuple[int, int]], cache_size: int = 1024):
+        self.file_path = file_path
+        self.index = index
+        self.cache_size = cache_size
+        self._setup()
+
+    def _setup(self) -> None:
+        self._file = None # opened on first access
+        self._lock = threading.Lock() # Streamlit sessions run in parallel threads sharing one file handle
+        self._get_record = functools.lru_cache(maxsize=self.cache_size)(self._read_record)
+
+    def _read_record(self, doc_id: str) -> dict:
+        offset, length = self.index[doc_id]
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.file_path, 'rb')
+            self._file.seek(offset)
+            line = self._file.read(length)
+        return json.loads(line)
+
+    def __getitem__(self, doc_id: str) -> dict:
+        if doc_id not in self.index:
+            raise KeyError(doc_id)
+        return self._get_record(doc_id)
+
+    def __contains__(self, doc_id: object) -> bool:
+        return doc_id in self.index # no parsing needed for membership tests
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def cache_info(self):
+        """Hits & misses of the parsed records' LRU cache (see `functools.lru_cache`)."""
+        return self._get_record.cache_info()
+
+    # Only the path and the index are pickled (e.g., for worker processes) -- file handles and caches are re-created
+    def __getstate__(self) -> dict:
+        return {'file_path': self.file_path, 'index': self.index, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._setup()
+
+def load_lookups(file_path: str, cache_size: int = 1024) -> LazyJsonlLookup:
+    """
+    Construct a lazy lookup for fast access to evidence content by 'id' without loading the whole file.
+
+    Args:
+        file_path (str): Path to the JSONL evidence file.
+        cache_size (int): Number of recently parsed records kept in memory.
+
+    Returns:
+        Lazy mapping from evidences' IDs to their content.
+    """
+    return LazyJsonlLookup(file_path, load_jsonl_index(file_path), cache_size=cache_size)
+
 def construct_table_from_lookups(tab_json: dict[str, dict]) -> pd.DataFrame:
     """
     Construct a table for a JSON-format table evidence in a DataFrame format.
@@ -76,32 +240,240 @@ def construct_table_from_lookups(tab_json: dict[str, dict]) -> pd.DataFrame:
     df = pd.DataFrame(rows, columns=unique_headers)
     return df
 
-def prepare_all_data(qs_path: str, imgs_path: str, tabs_path: str, txts_path: str) -> tuple[dict[str, list[dict]], dict[str, dict], dict[str, dict], dict[str, dict]]:
+def construct_highlight_mask(shape: tuple[int, int], table_indices: list[list[int]]) -> np.ndarray:
+    """
+    Construct a boolean mask of the cells cited as evidence in a table.
+
+    Args:
+        shape (tuple): (rows, columns) of the table's DataFrame.
+        table_indices (list): [row, column] pairs of the cited cells.
+
+    Returns:
+        mask (np.ndarray): Boolean array of the given shape, True for the cited cells.
+    """
+    mask = np.zeros(shape, dtype=bool)
+    if table_indices:
+        indices = np.asarray(table_indices, dtype=int).reshape(-1, 2)
+        # Drop indices out of the table's bounds (the annotations are not always consistent with the table)
+        valid = (indices >= 0).all(axis=1) & (indices[:, 0] < shape[0]) & (indices[:, 1] < shape[1])
+        mask[indices[valid, 0], indices[valid, 1]] = True
+    return mask
+
+# Words too common in evidence titles to be worth indexing
+TITLE_STOPWORDS = frozenset(['the', 'and', 'for', 'from', 'with', 'list', 'of', 'in', 'on', 'at', 'to', 'by', 'an', 'a'])
+
+def title_keywords(title: str) -> set[str]:
+    """
+    Split an evidence title (or a search query) into the keywords it is indexed by.
+
+    Args:
+        title (str): Title of the evidence.
+
+    Returns:
+        keywords (set): Lower-cased alphanumeric words, without stopwords and single characters.
+    """
+    return {word for word in re.findall(r'\w+', title.lower()) if len(word) > 1 and word not in TITLE_STOPWORDS}
+
+def build_navigation_index(convs: dict[str, list[dict]], imgs_lookups: Mapping[str, dict], tabs_lookups: Mapping[str, dict],
+                           txts_lookups: Mapping[str, dict]) -> dict[str, dict]:
+    """
+    Build the inverted indexes for navigating conversations by the evidences they cite, in one pass over all turns.
+    Only evidences cited by some turn are indexed, so that only their records get parsed.
+
+    Args:
+        convs (dict): Grouped conversations by their ID.
+        imgs_lookups (Mapping): Image doc IDs to their metadata.
+        tabs_lookups (Mapping): Table doc IDs to their content.
+        txts_lookups (Mapping): Text doc IDs to their content.
+
+    Returns:
+        index (dict): 'doc_turns' (doc_id -> qids of the turns citing it), 'doc_convs' (doc_id -> conversation IDs),
+        'modality_turns' & 'modality_convs' (answer modality -> qids / conversation IDs), 'keyword_docs'
+        (title keyword -> doc_ids), 'docs' (doc_id -> (modality, title)) and 'turn_positions' (qid -> (conversation ID, turn index)).
+    """
+    doc_turns, doc_convs, modality_turns, modality_convs, turn_positions = {}, {}, {}, {}, {}
+    cited = {} # doc_id -> modality
+    for conv_id, conv in convs.items():
+        for position, turn in enumerate(conv):
+            qid = turn['qid']
+            turn_positions[qid] = (conv_id, position)
+            for ans in turn.get('answer', []):
+                modality = ans.get('modality')
+                # Table cells are cited at the "answer level", but the table itself at the "question level"
+                if modality == 'image':
+                    doc_ids = [inst['doc_id'] for inst in ans.get('image_instances', [])]
+                elif modality == 'text':
+                    doc_ids = [inst['doc_id'] for inst in ans.get('text_instances', [])]
+                elif modality == 'table' and ans.get('table_indices') and turn.get('table_id'):
+                    doc_ids = [turn['table_id']]
+                else:
+                    doc_ids = []
+                if modality:
+                    modality_turns.setdefault(modality, {})[qid] = None # dicts keep the first-seen order without duplicates
+                    modality_convs.setdefault(modality, {})[conv_id] = None
+                for doc_id in doc_ids:
+                    doc_turns.setdefault(doc_id, {})[qid] = None
+                    doc_convs.setdefault(doc_id, {})[conv_id] = None
+                    cited[doc_id] = modality
+    lookups = {'image': imgs_lookups, 'table': tabs_lookups, 'text': txts_lookups}
+    docs, keyword_docs = {}, {}
+    for doc_id, modality in cited.items():
+        title = lookups[modality][doc_id].get('title', '') if doc_id in lookups[modality] else ''
+        docs[doc_id] = (modality, title)
+        for keyword in title_keywords(title):
+            keyword_docs.setdefault(keyword, []).append(doc_id)
+    return {
+        'doc_turns': {doc_id: list(qids) for doc_id, qids in doc_turns.items()},
+        'doc_convs': {doc_id: list(conv_ids) for doc_id, conv_ids in doc_convs.items()},
+        'modality_turns': {modality: list(qids) for modality, qids in modality_turns.items()},
+        'modality_convs': {modality: list(conv_ids) for modality, conv_ids in modality_convs.items()},
+        'keyword_docs': keyword_docs,
+        'docs': docs,
+        'turn_positions': turn_positions,
+    }
+
+def search_evidences(index: dict[str, dict], query: str) -> list[str]:
+    """
+    Find the cited evidences whose titles contain all keywords of a query.
+
+    Args:
+        index (dict): Navigation index as returned by `build_navigation_index`.
+        query (str): Keywords to search for (a doc ID also matches itself).
+
+    Returns:
+        doc_ids (list): Matching doc IDs, sorted by title.
+    """
+    if query in index['docs']:
+        matches = {query}
+    else:
+        keywords = title_keywords(query)
+        if not keywords:
+            return []
+        # Intersect the postings, smallest first
+        postings = sorted((set(index['keyword_docs'].get(keyword, ())) for keyword in keywords), key=len)
+        matches = set.intersection(*postings)
+    return sorted(matches, key=lambda doc_id: index['docs'][doc_id][1])
+
+# Bump whenever the snapshot layout changes so that stale snapshots get rebuilt
+SNAPSHOT_VERSION = 2
+
+def file_content_hash(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Hash the full content of a file, read in chunks to keep memory bounded.
+
+    Args:
+        file_path (str): Path to the file.
+        chunk_size (int): Number of bytes read at a time.
+
+    Returns:
+        digest (str): Hex digest of the file content.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _snapshot_is_valid(manifest: dict, sources: list[str]) -> bool:
+    """Check a snapshot's manifest against the current source files, hashing only the files whose size/mtime changed.
+    Fingerprints of files whose content turns out unchanged are refreshed in place."""
+    if manifest.get('version') != SNAPSHOT_VERSION or [entry['path'] for entry in manifest['sources']] != sources:
+        return False
+    for entry in manifest['sources']:
+        if file_fingerprint(entry['path']) == entry['fingerprint']:
+            continue
+        # The file was touched (e.g., copied or re-downloaded) -- only its content decides
+        if not path.exists(entry['path']) or entry['hash'] is None or file_content_hash(entry['path']) != entry['hash']:
+            return False
+        entry['fingerprint'] = file_fingerprint(entry['path'])
+    return True
+
+def _load_snapshot(snapshot_path: str, sources: list[str]) -> dict | None:
+    """Load a prepared-data snapshot if it exists and matches the current source files."""
+    try:
+        with open(snapshot_path + '.manifest.json', 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+        fingerprints = [entry['fingerprint'] for entry in manifest['sources']]
+        if not _snapshot_is_valid(manifest, sources):
+            return None
+        with open(snapshot_path, 'rb') as file:
+            snapshot = pickle.load(file)
+        # Avoid re-hashing touched-but-unchanged files on the next start
+        if fingerprints != [entry['fingerprint'] for entry in manifest['sources']]:
+            atomic_write(snapshot_path + '.manifest.json', lambda file: json.dump(manifest, file))
+        return snapshot
+    except (OSError, ValueError, KeyError, pickle.UnpicklingError, EOFError):
+        return None # missing or corrupted -- rebuild
+
+def _source_manifest(sources: list[str]) -> dict:
+    """Describe the source files of a snapshot -- taken before reading them, so that a file changing in the meantime
+    makes the snapshot stale instead of being vouched for."""
+    return {'version': SNAPSHOT_VERSION,
+            'sources': [{'path': src, 'fingerprint': file_fingerprint(src), 'hash': file_content_hash(src) if path.exists(src) else None}
+                        for src in sources]}
+
+def _write_snapshot(snapshot_path: str, manifest: dict, snapshot: dict) -> None:
+    """Atomically write a prepared-data snapshot and the manifest of the source files it was built from (see `_source_manifest`)."""
+    try:
+        os.makedirs(path.dirname(snapshot_path), exist_ok=True)
+        # Unique temporary files, as the app and the CLIs may build the same snapshot concurrently
+        atomic_write(snapshot_path, lambda file: pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL), binary=True)
+        # The manifest is replaced last so that it never vouches for a partially written snapshot
+        atomic_write(snapshot_path + '.manifest.json', lambda file: json.dump(manifest, file))
+    except OSError as e:
+        print(f"Warning: Could not write snapshot to {snapshot_path}. Error: {e}")
+
+def prepare_all_data(qs_path: str, imgs_path: str, tabs_path: str, txts_path: str, cache_dir: str | None = None,
+                     use_cache: bool = True) -> tuple[dict[str, list[dict]], Mapping[str, dict], Mapping[str, dict], Mapping[str, dict], dict[str, dict]]:
     """
     Prepares all data for images, tables, and texts against each question.
+    The prepared data is snapshotted in a binary file that is reused until one of the source files changes.
 
     Args:
         qs_path (str): Path to the file associating questions with their evidences' doc IDs.
         imgs_path (str): Path to the file associating images with their doc IDs.
         tabs_path (str): Path to the file associating tables with their doc IDs.
         txts_path (str): Path to the file associating texts with their doc IDs.
+        cache_dir (str | None): Directory for the snapshot (defaults to '.cache' beside the questions file).
+        use_cache (bool): Whether to read and write the snapshot at all.
 
     Returns:
-        tuple(dict, dict, dict, dict): Grouped conversations, image lookups, table lookups, and text lookups.
-    """
-    print("Step 1: Loading all raw data files...")
-    qs_data = load_data(qs_path)
-    imgs_data = load_data(imgs_path)
-    tabs_data = load_data(tabs_path)
-    txts_data = load_data(txts_path)
-    print("Step 2: Grouping questions into conversations...")
-    convs = group_by_conversation(qs_data)
-    print("Step 3: Constructing lookups for all modalities' evidences...")
-    imgs_lookups = construct_lookups(imgs_data)
-    tabs_lookups = construct_lookups(tabs_data)
-    txts_lookups = construct_lookups(txts_data)
-    print("Data Preparation Complete.\n")
-    return convs, imgs_lookups, tabs_lookups, txts_lookups
+        tuple(dict, Mapping, Mapping, Mapping, dict): Grouped conversations, lazy image, table, and text lookups
+        (empty for missing evidence files), and the navigation index (see `build_navigation_index`).
+
+    Raises:
+        FileNotFoundError: If the questions file is missing.
+    """
+    if not path.exists(qs_path):
+        raise FileNotFoundError(f"Questions file {qs_path} not found")
+    sources = [path.abspath(p) for p in (qs_path, imgs_path, tabs_path, txts_path)]
+    # One snapshot per combination of source files (e.g., one per split)
+    snapshot_name = hashlib.blake2b('|'.join(sources).encode('utf-8'), digest_size=8).hexdigest()
+    snapshot_path = path.join(cache_dir or path.join(path.dirname(sources[0]), '.cache'), f'prepared_{snapshot_name}.pkl')
+    snapshot = _load_snapshot(snapshot_path, sources) if use_cache else None
+    manifest = None
+    if snapshot is not None:
+        print("Loaded prepared data from snapshot.\n")
+    else:
+        manifest = _source_manifest(sources) if use_cache else None
+        print("Step 1: Loading all questions...")
+        qs_data = load_data(qs_path)
+        print("Step 2: Grouping questions into conversations...")
+        convs = group_by_conversation(qs_data)
+        print("Step 3: Indexing all modalities' evidences for lazy lookups...")
+        snapshot = {'convs': convs, 'imgs_index': load_jsonl_index(imgs_path),
+                    'tabs_index': load_jsonl_index(tabs_path), 'txts_index': load_jsonl_index(txts_path)}
+    # Evidences are only parsed when a conversation actually touches them
+    imgs_lookups = LazyJsonlLookup(imgs_path, snapshot['imgs_index'])
+    tabs_lookups = LazyJsonlLookup(tabs_path, snapshot['tabs_index'], cache_size=256) # tables are by far the largest records
+    txts_lookups = LazyJsonlLookup(txts_path, snapshot['txts_index'])
+    if 'nav_index' not in snapshot:
+        print("Step 4: Indexing conversations by their cited evidences...")
+        snapshot['nav_index'] = build_navigation_index(snapshot['convs'], imgs_lookups, tabs_lookups, txts_lookups)
+        if manifest is not None:
+            _write_snapshot(snapshot_path, manifest, snapshot)
+        print("Data Preparation Complete.\n")
+    return snapshot['convs'], imgs_lookups, tabs_lookups, txts_lookups, snapshot['nav_index']
 
 
 if __name__ == "__main__":
@@ -111,11 +483,12 @@ if __name__ == "__main__":
     imgs_path = r'.\data\multimodalqa_final_dataset_pipeline_camera_ready_MMQA_images.jsonl'
     tabs_path = r'.\data\multimodalqa_final_dataset_pipeline_camera_ready_MMQA_tables.jsonl'
     txts_path = r'.\data\multimodalqa_final_dataset_pipeline_camera_ready_MMQA_texts.jsonl'
-    convs, imgs_lookups, tabs_lookups, txts_lookups = prepare_all_data(qs_path, imgs_path, tabs_path, txts_path)
+    convs, imgs_lookups, tabs_lookups, txts_lookups, nav_index = prepare_all_data(qs_path, imgs_path, tabs_path, txts_path)
     print(f"Loaded {len(convs)} conversations.")
     print(f"Indexed {len(imgs_lookups)} image metadata.")
     print(f"Indexed {len(tabs_lookups)} tables metadata.")
     print(f"Indexed {len(txts_lookups)} text passages metadata.")
+    print(f"Indexed {len(nav_index['docs'])} cited evidences by {len(nav_index['keyword_docs'])} title keywords.")
     # Demo: Retrieve the image metadata from conversation C_381
     print("Demo: Retrieve the first image metadata from conversation C_381...")
     turn = convs['C_381'][0]
@@ -0,0 +1,256 @@
+import os
+import json
+import argparse
+import numpy as np
+from os import path
+from tqdm import tqdm
+
+from data_loader import load_data, construct_lookups, file_fingerprint
+
+
+# Bump whenever the on-disk layout changes so that stale stores get rebuilt
+STORE_VERSION = 2
+MATRIX_FILENAME = 'embeddings.npy'
+MANIFEST_FILENAME = 'manifest.json'
+# Question embeddings (see `clip_analyzer.TextEmbeddingCache`), kept next to the image embeddings
+TEXT_CACHE_FILENAME = 'text_embeddings.npz'
+
+def load_embedding_store(store_dir: str, checkpoint: str) -> tuple[np.ndarray, dict[str, list]] | None:
+    """
+    Memory-map a precomputed image embedding store built with `build_embedding_store`.
+
+    Args:
+        store_dir (str): Directory holding the embedding matrix and its manifest.
+        checkpoint (str): CLIP checkpoint (see `clip_analyzer.model_tag`) the embeddings must have been computed with.
+
+    Returns:
+        tuple(np.ndarray, dict) | None: The read-only (N, D) embedding matrix and the doc_id -> [row, fingerprint] index,
+        or None if the store is missing, outdated or was built with another checkpoint.
+    """
+    manifest_path = path.join(store_dir, MANIFEST_FILENAME)
+    matrix_path = path.join(store_dir, MATRIX_FILENAME)
+    if not (path.exists(manifest_path) and path.exists(matrix_path)):
+        return None
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+        # Rows are only read on demand -- the OS pages them in lazily
+        matrix = np.load(matrix_path, mmap_mode='r')
+    except Exception as e:
+        print(f"Error loading embedding store from {store_dir}: {e}")
+        return None
+    if manifest.get('version') != STORE_VERSION or manifest.get('checkpoint') != checkpoint:
+        return None
+    # In case the matrix and the manifest went out of sync (e.g., a build interrupted between replacing the two)
+    if file_fingerprint(matrix_path) != manifest.get('matrix') or list(matrix.shape) != [len(manifest['rows']), manifest.get('dim')]:
+        return None
+    return matrix, manifest['rows']
+
+def lookup_img_embeddings(store: tuple[np.ndarray, dict[str, list]] | None, doc_ids: list[str], img_paths: list[str]) -> dict[str, np.ndarray]:
+    """
+    Retrieve the cached embeddings of the given images whose files did not change since the store was built.
+
+    Args:
+        store (tuple | None): Embedding store as returned by `load_embedding_store`.
+        doc_ids (list): Doc IDs of the images.
+        img_paths (list): Paths to the image files, aligned with `doc_ids`.
+
+    Returns:
+        embeddings (dict): Mapping from doc IDs to their float32 normalized embeddings (misses are left out).
+    """
+    if store is None:
+        return {}
+    matrix, rows = store
+    embeddings = {}
+    for doc_id, img_path in zip(doc_ids, img_paths):
+        entry = rows.get(doc_id)
+        # Skip images never encoded or modified afterwards
+        if entry is not None and entry[1] == file_fingerprint(img_path):
+            embeddings[doc_id] = np.asarray(matrix[entry[0]], dtype=np.float32)
+    return embeddings
+
+def row_doc_ids(rows: dict[str, list]) -> list[str]:
+    """
+    Invert a store's doc_id -> [row, fingerprint] index.
+
+    Args:
+        rows (dict): Index as returned by `load_embedding_store`.
+
+    Returns:
+        doc_ids (list): Doc ID of each row of the embedding matrix.
+    """
+    doc_ids = [None] * len(rows)
+    for doc_id, (row, _) in rows.items():
+        doc_ids[row] = doc_id
+    return doc_ids
+
+def load_ann_index(store_dir: str, matrix: np.ndarray, kind: str = 'hnsw'):
+    """
+    Load the approximate nearest neighbor index over a store's embeddings, building (and persisting) it if missing or stale.
+
+    Args:
+        store_dir (str): Directory of the embedding store.
+        matrix (np.ndarray): The store's (N, D) embedding matrix.
+        kind (str): 'hnsw' (graph-based, no training) or 'ivf' (inverted lists over k-means clusters).
+
+    Returns:
+        index (faiss.Index): Inner-product index whose ids are the rows of the matrix.
+    """
+    import faiss # optional dependency, only needed for approximate search
+
+    index_path = path.join(store_dir, f'ann_{kind}.faiss')
+    matrix_path = path.join(store_dir, MATRIX_FILENAME)
+    # Reuse the persisted index unless the store was rebuilt afterwards
+    if path.exists(index_path) and os.stat(index_path).st_mtime_ns >= os.stat(matrix_path).st_mtime_ns:
+        index = faiss.read_index(index_path)
+        if index.ntotal == matrix.shape[0]:
+            return index
+    print(f"Building {kind.upper()} index over {matrix.shape[0]} embeddings...")
+    vectors = np.ascontiguousarray(matrix, dtype=np.float32) # faiss only takes float32
+    dim = vectors.shape[1]
+    if kind == 'hnsw':
+        index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT) # inner product <==> cosine for normalized embeddings
+        index.hnsw.efSearch = 64
+    elif kind == 'ivf':
+        nlist = max(1, int(np.sqrt(vectors.shape[0]))) # the usual sqrt(N) clusters
+        index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        index.nprobe = min(nlist, 16)
+    else:
+        raise ValueError(f"Unknown index kind '{kind}' -- expected 'hnsw' or 'ivf'")
+    index.add(vectors)
+    faiss.write_index(index, index_path)
+    return index
+
+def build_embedding_store(imgs_lookups: dict[str, dict], img_files_dir: str, store_dir: str, model, processor, checkpoint: str,
+                          dtype: str = 'float16', batch_size: int = 32, num_workers: int = 4) -> int:
+    """
+    Encode all image evidences once and persist their embeddings as a memory-mappable matrix plus a doc_id -> row index.
+    Rows of an existing store are reused as long as the checkpoint and the image files are unchanged.
+
+    Args:
+        imgs_lookups (dict): Dictionary mapping image doc IDs to their metadata.
+        img_files_dir (str): Directory holding the image files.
+        store_dir (str): Directory to write the embedding store to.
+        model (CLIPModel): Pretrained CLIP model.
+        processor (CLIPProcessor): Pretrained CLIP processor.
+        checkpoint (str): CLIP checkpoint (see `clip_analyzer.model_tag`) the store is keyed by.
+        dtype (str): Storage precision, either 'float16' or 'float32'.
+        batch_size (int): Number of images encoded per forward pass.
+        num_workers (int): Number of threads decoding & pre-processing images.
+
+    Returns:
+        count (int): Number of images in the resulting store.
+    """
+    from clip_analyzer import get_img_embeddings # model-side dependency only needed when building
+
+    os.makedirs(store_dir, exist_ok=True)
+    previous = load_embedding_store(store_dir, checkpoint)
+    # Split the images into those whose embeddings can be reused and those to be (re-)encoded
+    reused, to_encode = {}, []
+    for doc_id, img in imgs_lookups.items():
+        if not img.get('path'):
+            continue
+        img_path = path.join(img_files_dir, img['path'])
+        fingerprint = file_fingerprint(img_path)
+        # In case the image file is missing
+        if fingerprint is None:
+            continue
+        if previous is not None and previous[1].get(doc_id, [None, None])[1] == fingerprint:
+            reused[doc_id] = fingerprint
+        else:
+            to_encode.append((doc_id, img_path, fingerprint))
+    print(f"Reusing {len(reused)} cached embeddings, encoding {len(to_encode)} images...")
+    encoded = {}
+    # Chunks of several batches keep the progress bar moving while images are decoded in parallel
+    chunk_size = batch_size * 8
+    for start in tqdm(range(0, len(to_encode), chunk_size), desc="Encoding Images"):
+        batch = to_encode[start:start + chunk_size]
+        embeds = get_img_embeddings([img_path for _, img_path, _ in batch], model, processor, batch_size=batch_size, num_workers=num_workers)
+        for (doc_id, _, fingerprint), embed in zip(batch, embeds):
+            # Images that failed to load come back as NaN rows
+            if not np.isnan(embed).any():
+                encoded[doc_id] = (embed, fingerprint)
+    dim = model.config.projection_dim
+    count = len(reused) + len(encoded)
+    # Write to temporary files first so that an interrupted build never corrupts the current store
+    matrix_tmp = path.join(store_dir, MATRIX_FILENAME + '.tmp')
+    matrix = np.lib.format.open_memmap(matrix_tmp, mode='w+', dtype=dtype, shape=(count, dim))
+    rows = {}
+    for doc_id, fingerprint in reused.items():
+        rows[doc_id] = [len(rows), fingerprint]
+        matrix[rows[doc_id][0]] = previous[0][previous[1][doc_id][0]]
+    for doc_id, (embed, fingerprint) in encoded.items():
+        rows[doc_id] = [len(rows), fingerprint]
+        matrix[rows[doc_id][0]] = embed
+    matrix.flush()
+    del matrix
+    # The manifest vouches for this exact matrix file (its fingerprint survives the rename below)
+    manifest = {'version': STORE_VERSION, 'checkpoint': checkpoint, 'dtype': dtype, 'dim': dim,
+                'matrix': file_fingerprint(matrix_tmp), 'rows': rows}
+    manifest_tmp = path.join(store_dir, MANIFEST_FILENAME + '.tmp')
+    with open(manifest_tmp, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file)
+    # Release the memory map of the previous store before replacing it (required on Windows)
+    del previous
+    # The manifest is replaced last: until then, the previous manifest no longer matches the new matrix and is rejected
+    os.replace(matrix_tmp, path.join(store_dir, MATRIX_FILENAME))
+    os.replace(manifest_tmp, path.join(store_dir, MANIFEST_FILENAME))
+    return count
+
+def build_text_cache(qs_paths: list[str], model, processor, cache, batch_size: int = 64) -> int:
+    """
+    Encode all questions of the given conversation files into a text embedding cache and persist it.
+
+    Args:
+        qs_paths (list): Paths to MMCoQA question files (e.g., `MMCoQA_dev.txt`).
+        model (CLIPModel): Pretrained CLIP model.
+        processor (CLIPProcessor): Pretrained CLIP processor.
+        cache (TextEmbeddingCache): Cache to fill, with a `cache_path` to save to.
+        batch_size (int): Number of texts encoded per forward pass.
+
+    Returns:
+        count (int): Number of embeddings in the cache.
+    """
+    from clip_analyzer import get_txt_embeddings # model-side dependency only needed when building
+
+    questions = [turn['question'] for qs_path in qs_paths for turn in load_data(qs_path)]
+    # Already cached questions are skipped, repeated ones are encoded once
+    get_txt_embeddings(questions, model, processor, batch_size=batch_size, cache=cache)
+    cache.save()
+    return len(cache)
+
+
+if __name__ == "__main__":
+    from clip_analyzer import CLIP_CHECKPOINT, CLIP_BACKENDS, TextEmbeddingCache, load_clip, model_tag
+
+    parser = argparse.ArgumentParser(description="Precompute the CLIP embeddings of all image evidences.")
+    parser.add_argument('--data-dir', default='./data/', help="Directory holding the MMQA files.")
+    parser.add_argument('--store-dir', default=None, help="Output directory (defaults to <data-dir>/clip_embeddings).")
+    parser.add_argument('--checkpoint', default=CLIP_CHECKPOINT, help="CLIP checkpoint to encode with (or 'small'/'large').")
+    parser.add_argument('--backend', default='fp32', choices=CLIP_BACKENDS, help="Inference backend (stores are kept apart per backend).")
+    parser.add_argument('--num-threads', type=int, default=None, help="Intra-op threads for inference.")
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'float32'], help="Storage precision of the embeddings.")
+    parser.add_argument('--batch-size', type=int, default=32, help="Number of images encoded per forward pass.")
+    parser.add_argument('--num-workers', type=int, default=4, help="Number of threads decoding & pre-processing images.")
+    parser.add_argument('--questions', nargs='*', default=None, help="Question files to also precompute the text embeddings of (defaults to <data-dir>/MMCoQA_dev.txt if given without paths).")
+    parser.add_argument('--questions-only', action='store_true', help="Only precompute the question embeddings, skipping the images.")
+    args = parser.parse_args()
+
+    imgs_jsonl_path = path.join(args.data_dir, 'multimodalqa_final_dataset_pipeline_camera_ready_MMQA_images.jsonl')
+    img_files_dir = path.join(args.data_dir, 'final_dataset_images')
+    store_dir = args.store_dir or path.join(args.data_dir, 'clip_embeddings')
+    tag = model_tag(args.checkpoint, args.backend)
+    model, processor = load_clip(args.checkpoint, backend=args.backend, num_threads=args.num_threads)
+    if not args.questions_only:
+        imgs_lookups = construct_lookups(load_data(imgs_jsonl_path))
+        count = build_embedding_store(imgs_lookups, img_files_dir, store_dir, model, processor, tag,
+                                      dtype=args.dtype, batch_size=args.batch_size, num_workers=args.num_workers)
+        print(f"Stored {count} image embeddings in {store_dir}.")
+    if args.questions is not None or args.questions_only:
+        qs_paths = args.questions or [path.join(args.data_dir, 'MMCoQA_dev.txt')]
+        cache_path = path.join(store_dir, TEXT_CACHE_FILENAME)
+        # Sized to hold every question, unlike the default in-memory bound
+        cache = TextEmbeddingCache(tag, maxsize=1 << 20, cache_path=cache_path)
+        count = build_text_cache(qs_paths, model, processor, cache)
+        print(f"Stored {count} question embeddings in {cache_path}.")
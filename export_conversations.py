@@ -0,0 +1,254 @@
+import os
+import json
+import argparse
+import numpy as np
+from os import path
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from data_loader import prepare_all_data, construct_table_from_lookups, construct_highlight_mask, file_fingerprint, atomic_write
+
+
+# Columns of the Parquet export, one row per (turn, answer, evidence)
+EVIDENCE_COLUMNS = ['conv_id', 'qid', 'turn', 'question', 'answer_index', 'answer', 'modality', 'doc_id', 'found',
+                    'title', 'url', 'img_path', 'text', 'table_columns', 'table_rows', 'highlighted_cells']
+# Prefixed with '_' so that readers of the whole directory (e.g., `pd.read_parquet(output_dir)`) skip it as a non-data file
+MANIFEST_FILENAME = '_manifest.json'
+LEGACY_MANIFEST_FILENAME = 'manifest.json' # written by earlier versions, only read to reuse & clean up their shards
+
+def resolve_evidence(doc_id: str, modality: str, lookups: dict, img_files_dir: str, table_indices: list | None = None) -> dict:
+    """
+    Resolve an evidence cited by an answer into its content.
+
+    Args:
+        doc_id (str): Doc ID of the evidence.
+        modality (str): 'image', 'table' or 'text'.
+        lookups (dict): Mapping from modalities to their evidence lookups.
+        img_files_dir (str): Directory holding the image files.
+        table_indices (list | None): [row, column] pairs of the cited cells (tables only).
+
+    Returns:
+        evidence (dict): The doc ID, whether it was 'found', its title & URL, and the resolved 'img_path', 'text', or
+        table ('table_columns', 'table_rows' and in-bounds 'highlighted_cells').
+    """
+    if doc_id not in lookups[modality]:
+        return {'doc_id': doc_id, 'found': False}
+    record = lookups[modality][doc_id]
+    evidence = {'doc_id': doc_id, 'found': True, 'title': record.get('title'), 'url': record.get('url')}
+    if modality == 'image':
+        img_path = path.abspath(path.join(img_files_dir, record.get('path', '')))
+        evidence['img_path'] = img_path
+        evidence['found'] = bool(record.get('path')) and path.exists(img_path)
+    elif modality == 'text':
+        evidence['text'] = record.get('text')
+    elif modality == 'table':
+        df = construct_table_from_lookups(record['table'])
+        evidence['table_columns'] = [str(c) for c in df.columns]
+        evidence['table_rows'] = df.astype(str).values.tolist()
+        # Same cells as highlighted in the app, out-of-bounds annotations dropped
+        evidence['highlighted_cells'] = np.argwhere(construct_highlight_mask(df.shape, table_indices)).tolist()
+    return evidence
+
+def resolve_conversation(conv_id: str, conv: list[dict], lookups: dict, img_files_dir: str) -> dict:
+    """
+    Resolve all evidences of a conversation, turn by turn and answer by answer.
+
+    Args:
+        conv_id (str): ID of the conversation.
+        conv (list): Turns of the conversation.
+        lookups (dict): Mapping from modalities to their evidence lookups.
+        img_files_dir (str): Directory holding the image files.
+
+    Returns:
+        conversation (dict): The conversation ID and its turns (with their 'turn' position, starting at 1 as in
+        `scores_analyzer.turn_metadata`), each answer with its resolved 'evidences'.
+    """
+    turns = []
+    for position, turn in enumerate(conv, start=1):
+        answers = []
+        for ans in turn.get('answer', []):
+            modality = ans.get('modality')
+            if modality == 'image':
+                evidences = [resolve_evidence(inst['doc_id'], 'image', lookups, img_files_dir) for inst in ans.get('image_instances', [])]
+            elif modality == 'text':
+                evidences = [resolve_evidence(inst['doc_id'], 'text', lookups, img_files_dir) for inst in ans.get('text_instances', [])]
+            elif modality == 'table' and ans.get('table_indices') and turn.get('table_id'):
+                # The table ID is provided at the "question level", its cited cells at the "answer level"
+                evidences = [resolve_evidence(turn['table_id'], 'table', lookups, img_files_dir, ans['table_indices'])]
+            else:
+                evidences = []
+            answers.append({'answer': ans.get('answer'), 'type': ans.get('type'), 'modality': modality, 'evidences': evidences})
+        turns.append({'qid': turn['qid'], 'turn': position, 'question': turn.get('question'), 'gold_question': turn.get('gold_question'),
+                      'question_type': turn.get('question_type'), 'answers': answers})
+    return {'conv_id': conv_id, 'turns': turns}
+
+def evidence_rows(conversation: dict) -> list[dict]:
+    """Flatten a resolved conversation into one row per (turn, answer, evidence) -- answers without evidences get one row."""
+    rows = []
+    for turn in conversation['turns']:
+        for answer_index, ans in enumerate(turn['answers']):
+            base = {'conv_id': conversation['conv_id'], 'qid': turn['qid'], 'turn': turn['turn'], 'question': turn['question'],
+                    'answer_index': answer_index, 'answer': None if ans['answer'] is None else str(ans['answer']), 'modality': ans['modality']}
+            for evidence in ans['evidences'] or [{}]:
+                rows.append({column: {**base, **evidence}.get(column) for column in EVIDENCE_COLUMNS})
+    return rows
+
+# Per-process state of the export workers, set once by `_init_worker` instead of being pickled with every shard
+_worker_state = {}
+
+def _init_worker(convs: dict[str, list[dict]], lookups: dict, img_files_dir: str) -> None:
+    # The lazy lookups only pickle their file paths & offsets -- each worker opens its own file handles and caches
+    _worker_state.update(convs=convs, lookups=lookups, img_files_dir=img_files_dir)
+
+def export_shard(conv_ids: list[str], shard_path: str, fmt: str = 'jsonl') -> tuple[str, int]:
+    """
+    Resolve a shard of conversations and write it to one file (atomically, so that partial shards never exist).
+
+    Args:
+        conv_ids (list): IDs of the conversations in the shard.
+        shard_path (str): File to write.
+        fmt (str): 'jsonl' (one nested conversation per line) or 'parquet' (one row per evidence, see `EVIDENCE_COLUMNS`).
+
+    Returns:
+        tuple(str, int): The shard's path and its number of conversations.
+    """
+    convs, lookups, img_files_dir = _worker_state['convs'], _worker_state['lookups'], _worker_state['img_files_dir']
+    tmp_path = f"{shard_path}.{os.getpid()}.tmp"
+    if fmt == 'jsonl':
+        # Streamed conversation by conversation
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            for conv_id in conv_ids:
+                file.write(json.dumps(resolve_conversation(conv_id, convs[conv_id], lookups, img_files_dir), ensure_ascii=False) + '\n')
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        rows = [row for conv_id in conv_ids for row in evidence_rows(resolve_conversation(conv_id, convs[conv_id], lookups, img_files_dir))]
+        pq.write_table(pa.Table.from_pylist(rows, schema=evidence_schema()), tmp_path)
+    os.replace(tmp_path, shard_path)
+    return shard_path, len(conv_ids)
+
+def evidence_schema():
+    """Fixed Parquet schema of `evidence_rows`, so that all shards agree even where a shard lacks a modality."""
+    import pyarrow as pa
+
+    return pa.schema([('conv_id', pa.string()), ('qid', pa.string()), ('turn', pa.int32()), ('question', pa.string()),
+                      ('answer_index', pa.int32()), ('answer', pa.string()), ('modality', pa.string()), ('doc_id', pa.string()),
+                      ('found', pa.bool_()), ('title', pa.string()), ('url', pa.string()), ('img_path', pa.string()), ('text', pa.string()),
+                      ('table_columns', pa.list_(pa.string())), ('table_rows', pa.list_(pa.list_(pa.string()))),
+                      ('highlighted_cells', pa.list_(pa.list_(pa.int32())))])
+
+def export_conversations(qs_path: str, imgs_path: str, tabs_path: str, txts_path: str, img_files_dir: str, output_dir: str,
+                         fmt: str = 'jsonl', shard_size: int = 100, num_workers: int = 4, max_in_flight: int | None = None,
+                         conv_ids: list[str] | None = None, overwrite: bool = False) -> dict:
+    """
+    Export conversations with their resolved evidences to sharded files, in parallel across a process pool.
+    Only `max_in_flight` shards are submitted at a time and workers write their shards themselves, so memory stays bounded
+    by a few shards regardless of the dataset size. Shards already written by an earlier run from the same source files,
+    image directory and format are skipped unless `overwrite`, and shards of the previous export that are not part of this
+    one (e.g., after changing `shard_size` or `conv_ids`) are deleted, so that the directory only ever holds one export.
+
+    Args:
+        qs_path (str): Path to the questions file.
+        imgs_path (str): Path to the image evidences file.
+        tabs_path (str): Path to the table evidences file.
+        txts_path (str): Path to the text evidences file.
+        img_files_dir (str): Directory holding the image files.
+        output_dir (str): Directory to write the shards and their manifest to.
+        fmt (str): 'jsonl' or 'parquet'.
+        shard_size (int): Number of conversations per shard.
+        num_workers (int): Number of worker processes.
+        max_in_flight (int | None): Maximum number of shards submitted at once (defaults to twice the workers).
+        conv_ids (list | None): Only export these conversations (all by default).
+        overwrite (bool): Whether to rewrite shards that already exist.
+
+    Returns:
+        manifest (dict): The export's settings and its shards with their conversations (also written to `MANIFEST_FILENAME`).
+    """
+    # Fingerprinted before reading, so that a source changing during the export invalidates its shards on the next run
+    sources = {path.abspath(p): file_fingerprint(p) for p in (qs_path, imgs_path, tabs_path, txts_path)}
+    convs, imgs_lookups, tabs_lookups, txts_lookups, _ = prepare_all_data(qs_path, imgs_path, tabs_path, txts_path)
+    lookups = {'image': imgs_lookups, 'table': tabs_lookups, 'text': txts_lookups}
+    conv_ids = sorted(conv_ids if conv_ids is not None else convs)
+    missing = [c for c in conv_ids if c not in convs]
+    if missing:
+        raise ValueError(f"Unknown conversation IDs: {', '.join(missing[:10])}")
+    os.makedirs(output_dir, exist_ok=True)
+    chunks = [conv_ids[start:start + shard_size] for start in range(0, len(conv_ids), shard_size)]
+    shards = [(chunk, path.join(output_dir, f"conversations-{i:05d}-of-{len(chunks):05d}.{fmt}")) for i, chunk in enumerate(chunks)]
+    # Shards are reused only if the previous export wrote them with the same conversations, from the same inputs
+    manifest_path = path.join(output_dir, MANIFEST_FILENAME)
+    legacy_manifest_path = path.join(output_dir, LEGACY_MANIFEST_FILENAME)
+    inputs = {'sources': sources, 'img_files_dir': path.abspath(img_files_dir), 'format': fmt}
+    previous_manifest = {}
+    previous_manifest_path = manifest_path if path.exists(manifest_path) else legacy_manifest_path
+    if path.exists(previous_manifest_path):
+        try:
+            with open(previous_manifest_path, 'r', encoding='utf-8') as file:
+                previous_manifest = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read {previous_manifest_path}, rewriting all shards. Error: {e}")
+    previous = {}
+    if not overwrite and all(previous_manifest.get(key) == value for key, value in inputs.items()):
+        previous = {shard['path']: shard['conv_ids'] for shard in previous_manifest.get('shards', [])}
+    todo = [(chunk, shard_path) for chunk, shard_path in shards
+            if previous.get(path.basename(shard_path)) != chunk or not path.exists(shard_path)]
+    print(f"Exporting {len(conv_ids)} conversations in {len(shards)} shards ({len(shards) - len(todo)} already written)...")
+    max_in_flight = max_in_flight or 2 * num_workers
+    # Only the conversations to export are sent to the workers
+    export_convs = {c: convs[c] for chunk, _ in todo for c in chunk}
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(export_convs, lookups, img_files_dir)) as pool, \
+            tqdm(total=len(todo), desc="Exporting Shards") as progress:
+        pending = set()
+        for chunk, shard_path in todo:
+            # Wait for a free slot before submitting more work
+            if len(pending) >= max_in_flight:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result() # re-raise worker errors
+                progress.update(len(finished))
+            pending.add(pool.submit(export_shard, chunk, shard_path, fmt))
+        for future in pending:
+            future.result()
+        progress.update(len(pending))
+    manifest = {'questions': path.abspath(qs_path), **inputs, 'shard_size': shard_size, 'num_conversations': len(conv_ids),
+                'shards': [{'path': path.basename(shard_path), 'num_conversations': len(chunk), 'conv_ids': chunk} for chunk, shard_path in shards]}
+    atomic_write(manifest_path, lambda file: json.dump(manifest, file, indent=2))
+    # Only once the new manifest is in place, delete the previous export's shards it no longer lists
+    current = {shard['path'] for shard in manifest['shards']}
+    stale = {path.basename(shard['path']) for shard in previous_manifest.get('shards', [])} - current
+    for shard_name in sorted(stale):
+        if path.exists(path.join(output_dir, shard_name)):
+            os.remove(path.join(output_dir, shard_name))
+    if stale:
+        print(f"Deleted {len(stale)} shards of the previous export.")
+    if path.exists(legacy_manifest_path):
+        os.remove(legacy_manifest_path)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export conversations with their resolved image, table and text evidences to sharded files.")
+    parser.add_argument('--data-dir', default='./data/', help="Directory holding the MMQA files.")
+    parser.add_argument('--qs-path', default=None, help="Questions file to export (defaults to <data-dir>/MMCoQA_dev.txt).")
+    parser.add_argument('--output-dir', default=None, help="Output directory (defaults to <data-dir>/export).")
+    parser.add_argument('--format', default='jsonl', choices=['jsonl', 'parquet'],
+                        help="'jsonl': one nested conversation per line; 'parquet': one row per (turn, answer, evidence).")
+    parser.add_argument('--shard-size', type=int, default=100, help="Number of conversations per shard.")
+    parser.add_argument('--num-workers', type=int, default=4, help="Number of worker processes.")
+    parser.add_argument('--max-in-flight', type=int, default=None, help="Maximum number of shards submitted at once (defaults to twice the workers).")
+    parser.add_argument('--conversations', nargs='+', default=None, help="Only export these conversation IDs.")
+    parser.add_argument('--overwrite', action='store_true', help="Rewrite shards written by an earlier run.")
+    args = parser.parse_args()
+
+    manifest = export_conversations(
+        args.qs_path or path.join(args.data_dir, 'MMCoQA_dev.txt'),
+        path.join(args.data_dir, 'multimodalqa_final_dataset_pipeline_camera_ready_MMQA_images.jsonl'),
+        path.join(args.data_dir, 'multimodalqa_final_dataset_pipeline_camera_ready_MMQA_tables.jsonl'),
+        path.join(args.data_dir, 'multimodalqa_final_dataset_pipeline_camera_ready_MMQA_texts.jsonl'),
+        path.join(args.data_dir, 'final_dataset_images'),
+        args.output_dir or path.join(args.data_dir, 'export'),
+        fmt=args.format, shard_size=args.shard_size, num_workers=args.num_workers, max_in_flight=args.max_in_flight,
+        conv_ids=args.conversations, overwrite=args.overwrite,
+    )
+    print(f"Exported {manifest['num_conversations']} conversations in {len(manifest['shards'])} shards.")
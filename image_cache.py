@@ -0,0 +1,133 @@
+import os
+import argparse
+import tempfile
+import functools
+from os import path
+from PIL import Image
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+
+from data_loader import load_lookups, file_fingerprint
+
+
+# Longest edge (in pixels) of the pre-generated display thumbnails
+THUMBNAIL_SIZES = (256, 512)
+# Number of pre-processed images kept in memory (~600KB each for ViT-L/14's 224x224 inputs)
+PIXEL_CACHE_SIZE = 256
+
+def get_thumbnail(img_path: str, doc_id: str, thumbs_dir: str, size: int = 512) -> str:
+    """
+    Get the display thumbnail of an image, generating it on disk if missing or older than the image.
+
+    Args:
+        img_path (str): Path to the original image file.
+        doc_id (str): Doc ID of the image, used as the thumbnail's file name.
+        thumbs_dir (str): Directory holding the thumbnails (one sub-directory per size).
+        size (int): Longest edge of the thumbnail in pixels.
+
+    Returns:
+        thumb_path (str): Path to the thumbnail, or to the original image if the thumbnail could not be generated.
+    """
+    thumb_path = path.join(thumbs_dir, str(size), f"{doc_id}.jpg")
+    try:
+        if path.exists(thumb_path) and os.stat(thumb_path).st_mtime_ns >= os.stat(img_path).st_mtime_ns:
+            return thumb_path
+        with Image.open(img_path) as img:
+            img = img.convert("RGB") # JPEG has no alpha channel
+            img.thumbnail((size, size)) # keeps the aspect ratio and never upscales
+            os.makedirs(path.dirname(thumb_path), exist_ok=True)
+            # Write to a unique temporary file first so that concurrent sessions (threads of one process) never serve a partial thumbnail
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=f"{doc_id}.", dir=path.dirname(thumb_path))
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    img.save(file, format="JPEG", quality=85)
+                os.replace(tmp_path, thumb_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        return thumb_path
+    except Exception as e:
+        print(f"Warning: Could not generate thumbnail for {img_path}. Error: {e}")
+        return img_path
+
+def preprocess_img(img_path: str, processor) -> "torch.Tensor | None":
+    """
+    Opens and pre-processes an image into CLIP's pixel values.
+
+    Args:
+        img_path (str): Path to the image file.
+        processor (CLIPProcessor): Pretrained CLIP processor.
+
+    Returns:
+        pixel_values (torch.Tensor | None): Tensor of shape (3, H, W), or None if the image could not be opened.
+    """
+    try:
+        img = Image.open(img_path).convert("RGB")
+    except Exception as e:
+        print(f"Warning: Could not open image {img_path}. Error: {e}")
+        return None
+    return processor(images=img, return_tensors="pt")['pixel_values'][0]
+
+@functools.lru_cache(maxsize=PIXEL_CACHE_SIZE)
+def _load_pixel_values(img_path: str, fingerprint: str, processor) -> "torch.Tensor":
+    # Raises on failure instead of returning None, so that failures are never cached
+    with Image.open(img_path) as img:
+        return processor(images=img.convert("RGB"), return_tensors="pt")['pixel_values'][0]
+
+def get_pixel_values(img_path: str, processor) -> "torch.Tensor | None":
+    """
+    Bounded in-process LRU over pre-processing, so that repeatedly analyzed images skip decoding & resizing.
+    Keyed by the image file's fingerprint (like the embedding store), so that edited images are pre-processed again.
+
+    Args:
+        img_path (str): Path to the image file.
+        processor (CLIPProcessor): Pretrained CLIP processor.
+
+    Returns:
+        pixel_values (torch.Tensor | None): Tensor of shape (3, H, W), or None if the image could not be opened.
+    """
+    try:
+        return _load_pixel_values(img_path, file_fingerprint(img_path), processor)
+    except Exception as e:
+        print(f"Warning: Could not open image {img_path}. Error: {e}")
+        return None
+
+# Same statistics as an `lru_cache`-decorated function (e.g., for `instrumentation.lru_cache_stats`)
+get_pixel_values.cache_info = _load_pixel_values.cache_info
+
+def build_thumbnails(imgs_lookups: dict[str, dict], img_files_dir: str, thumbs_dir: str, sizes: tuple[int, ...] = THUMBNAIL_SIZES,
+                     num_workers: int = 8) -> int:
+    """
+    Pre-generate the display thumbnails of all image evidences at fixed sizes.
+
+    Args:
+        imgs_lookups (dict): Dictionary mapping image doc IDs to their metadata.
+        img_files_dir (str): Directory holding the image files.
+        thumbs_dir (str): Directory to write the thumbnails to.
+        sizes (tuple): Longest edges of the thumbnails in pixels.
+        num_workers (int): Number of threads generating thumbnails.
+
+    Returns:
+        count (int): Number of thumbnails available.
+    """
+    jobs = [(path.join(img_files_dir, img['path']), doc_id, size)
+            for doc_id, img in imgs_lookups.items() if img.get('path') for size in sizes]
+    with ThreadPoolExecutor(max_workers=num_workers) as pool: # PIL releases the GIL while decoding & resizing
+        thumb_paths = list(tqdm(pool.map(lambda job: get_thumbnail(job[0], job[1], thumbs_dir, job[2]), jobs), total=len(jobs), desc="Generating Thumbnails"))
+    # Failed thumbnails fall back to the original image path
+    return sum(1 for (img_path, _, _), thumb_path in zip(jobs, thumb_paths) if thumb_path != img_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-generate the display thumbnails of all image evidences.")
+    parser.add_argument('--data-dir', default='./data/', help="Directory holding the MMQA files.")
+    parser.add_argument('--thumbs-dir', default=None, help="Output directory (defaults to <data-dir>/thumbnails).")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(THUMBNAIL_SIZES), help="Longest edges of the thumbnails in pixels.")
+    parser.add_argument('--num-workers', type=int, default=8, help="Number of threads generating thumbnails.")
+    args = parser.parse_args()
+
+    imgs_lookups = load_lookups(path.join(args.data_dir, 'multimodalqa_final_dataset_pipeline_camera_ready_MMQA_images.jsonl'))
+    thumbs_dir = args.thumbs_dir or path.join(args.data_dir, 'thumbnails')
+    count = build_thumbnails(imgs_lookups, path.join(args.data_dir, 'final_dataset_images'), thumbs_dir,
+                             sizes=tuple(args.sizes), num_workers=args.num_workers)
+    print(f"{count} thumbnails available in {thumbs_dir}.")
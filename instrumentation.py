@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import contextlib
+import functools
+import tracemalloc
+from os import path
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+try:
+    import resource # Unix only
+except ImportError:
+    resource = None
+
+
+# Number of recent durations kept per stage for the percentiles
+RECENT_SIZE = 256
+# Shared no-op context of disabled stages, so that instrumented code costs (almost) nothing by default
+_NO_STAGE = contextlib.nullcontext()
+
+class Metrics:
+    """
+    Process-wide, thread-safe recorder of per-stage timings, counters (e.g., cache hits & misses) and memory.
+    Stages nest per thread, so that their self times can also be exported as collapsed stacks (the flame graph
+    format of `py-spy record --format raw`, readable by speedscope or flamegraph.pl).
+
+    Disabled until `enable` is called -- every method is then a no-op.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self._lock = threading.Lock()
+        self._local = threading.local() # stack of the open stages of each thread
+        self._caches = {} # name -> callable returning (hits, misses)
+        self._logger = None
+        self.reset()
+
+    def enable(self, trace_memory: bool = False, log_path: str | None = None, log_max_bytes: int = 5 << 20, log_backups: int = 3) -> None:
+        """
+        Start recording.
+
+        Args:
+            trace_memory (bool): Also trace Python allocations with `tracemalloc` (slows allocations down noticeably).
+            log_path (str | None): JSON-lines file that `log_snapshot` appends to, rolled over once it reaches `log_max_bytes`.
+            log_max_bytes (int): Size of the metrics log before it is rolled over.
+            log_backups (int): Number of rolled over logs kept (e.g., metrics.jsonl.1, metrics.jsonl.2, ...).
+        """
+        self.enabled = True
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.trace_memory = trace_memory
+        if log_path and self._logger is None:
+            os.makedirs(path.dirname(log_path) or '.', exist_ok=True)
+            handler = RotatingFileHandler(log_path, maxBytes=log_max_bytes, backupCount=log_backups, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._logger = logging.getLogger(f"{__name__}.{id(self)}")
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            self._logger.addHandler(handler)
+
+    def reset(self) -> None:
+        """Drop everything recorded so far (registered caches stay registered)."""
+        with self._lock:
+            self._stages = {} # name -> {'count', 'total', 'max', 'recent', 'mem'}
+            self._counters = {}
+            self._stacks = {} # collapsed stack -> self time in seconds
+            self._started = time.time()
+
+    def stage(self, name: str):
+        """
+        Context manager timing a stage, e.g. `with metrics.stage('construct_table'): ...`.
+
+        Args:
+            name (str): Name of the stage (its timings are aggregated over all calls).
+        """
+        return self._stage(name) if self.enabled else _NO_STAGE
+
+    @contextlib.contextmanager
+    def _stage(self, name: str):
+        stack = self._local.__dict__.setdefault('stack', [])
+        frame = {'name': name, 'children': 0.0}
+        stack.append(frame)
+        mem_before = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            mem_delta = tracemalloc.get_traced_memory()[0] - mem_before if self.trace_memory else 0
+            stack.pop()
+            if stack:
+                stack[-1]['children'] += duration
+            collapsed = ';'.join([f['name'] for f in stack] + [name])
+            with self._lock:
+                stats = self._stages.get(name)
+                if stats is None:
+                    stats = self._stages[name] = {'count': 0, 'total': 0.0, 'max': 0.0, 'recent': deque(maxlen=RECENT_SIZE), 'mem': 0}
+                stats['count'] += 1
+                stats['total'] += duration
+                stats['max'] = max(stats['max'], duration)
+                stats['recent'].append(duration)
+                stats['mem'] += mem_delta
+                self._stacks[collapsed] = self._stacks.get(collapsed, 0.0) + duration - frame['children']
+
+    def timed(self, name: str | None = None):
+        """
+        Decorator timing every call of a function as a stage.
+
+        Args:
+            name (str | None): Name of the stage (defaults to the function's name).
+        """
+        def decorator(fn):
+            stage_name = name or fn.__name__
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage_name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Increase a counter, e.g. `metrics.count('cache_table.misses')`."""
+        if self.enabled:
+            with self._lock:
+                self._counters[name] = self._counters.get(name, 0) + n
+
+    def counter(self, name: str) -> int:
+        """Current value of a counter."""
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def register_cache(self, name: str, fn) -> None:
+        """
+        Report the hit rate of a cache in the snapshots.
+
+        Args:
+            name (str): Name of the cache.
+            fn (callable): Returns the (hits, misses) of the cache so far, e.g. from an `lru_cache`'s `cache_info()`.
+        """
+        self._caches[name] = fn
+
+    def snapshot(self) -> dict:
+        """
+        Summarize everything recorded so far.
+
+        Returns:
+            snapshot (dict): 'stages' (count, total/mean/p50/p95/max in ms, and retained traced memory in MB per stage),
+            'caches' (hits, misses and hit rate), 'counters' and 'memory' (peak RSS, and traced current/peak if traced).
+        """
+        with self._lock:
+            stages = {}
+            for name, stats in self._stages.items():
+                recent = sorted(stats['recent'])
+                stages[name] = {
+                    'count': stats['count'],
+                    'total_ms': stats['total'] * 1000,
+                    'mean_ms': stats['total'] / stats['count'] * 1000,
+                    'p50_ms': recent[len(recent) // 2] * 1000,
+                    'p95_ms': recent[min(len(recent) - 1, int(len(recent) * 0.95))] * 1000,
+                    'max_ms': stats['max'] * 1000,
+                    'mem_mb': stats['mem'] / 2**20,
+                }
+            counters = dict(self._counters)
+        caches = {}
+        for name, fn in self._caches.items():
+            try:
+                hits, misses = fn()
+            except Exception as e: # e.g., a cache that is not built yet
+                print(f"Warning: Could not read the statistics of cache '{name}'. Error: {e}")
+                continue
+            caches[name] = {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else None}
+        memory = {}
+        if resource is not None:
+            # `ru_maxrss` is in bytes on macOS, in KB on Linux
+            memory['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 1024)
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            memory.update(traced_current_mb=current / 2**20, traced_peak_mb=peak / 2**20)
+        return {'time': time.time(), 'uptime_s': time.time() - self._started, 'stages': stages, 'caches': caches,
+                'counters': counters, 'memory': memory}
+
+    def log_snapshot(self) -> None:
+        """Append the current snapshot as one JSON line to the rolling metrics log (if configured)."""
+        if self.enabled and self._logger is not None:
+            self._logger.info(json.dumps(self.snapshot()))
+
+    def dump_collapsed(self, file_path: str) -> str:
+        """
+        Write the self times of the stages as collapsed stacks ('stage;sub-stage <microseconds>' per line).
+
+        Args:
+            file_path (str): File to write to.
+
+        Returns:
+            file_path (str): The written file.
+        """
+        with self._lock:
+            lines = [f"{stack} {round(seconds * 1e6)}" for stack, seconds in sorted(self._stacks.items())]
+        os.makedirs(path.dirname(file_path) or '.', exist_ok=True)
+        with open(file_path, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+        return file_path
+
+@contextlib.contextmanager
+def profiled(dump_dir: str, name: str = 'profile'):
+    """
+    Profile a block with cProfile and dump the result, e.g. for `python -m pstats` or snakeviz.
+
+    Args:
+        dump_dir (str): Directory to write '<name>_<timestamp>.prof' (binary pstats) and a '.txt' summary to.
+        name (str): Prefix of the dump files.
+
+    Yields:
+        dump (dict): Filled with the 'path' of the binary dump once the block exits.
+    """
+    dump = {}
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield dump
+    finally:
+        profiler.disable()
+        os.makedirs(dump_dir, exist_ok=True)
+        dump['path'] = path.join(dump_dir, f"{name}_{time.strftime('%Y%m%d-%H%M%S')}.prof")
+        profiler.dump_stats(dump['path'])
+        # Human-readable top functions by cumulative time, next to the binary dump
+        with open(dump['path'][:-len('.prof')] + '.txt', 'w', encoding='utf-8') as file:
+            pstats.Stats(profiler, stream=file).sort_stats('cumulative').print_stats(40)
+
+def lru_cache_stats(fn) -> tuple[int, int]:
+    """(hits, misses) of a `functools.lru_cache`-decorated function, for `Metrics.register_cache`."""
+    info = fn.cache_info()
+    return info.hits, info.misses
+
+# The recorder shared by all modules of the process
+metrics = Metrics()
@@ -0,0 +1,184 @@
+import time
+import queue
+import threading
+import numpy as np
+
+from instrumentation import metrics
+from embedding_store import lookup_img_embeddings
+
+
+class SimilarityJob:
+    """
+    Request to score a question against a list of images, e.g. an image evidence and the other images of its conversation.
+
+    Args:
+        question (str): Question to score the images against.
+        doc_ids (list): Doc IDs of the images.
+        img_paths (list): Paths to the image files, aligned with `doc_ids`.
+    """
+    def __init__(self, question: str, doc_ids: list[str], img_paths: list[str]):
+        self.question = question
+        self.doc_ids = list(doc_ids)
+        self.img_paths = list(img_paths)
+        self.key = job_key(question, doc_ids)
+        self.status = 'queued' # -> 'running' -> 'done' | 'failed'
+        self.scores = None # np.ndarray aligned with `doc_ids` once done
+        self.error = None # message once failed
+        self.submitted = time.time()
+        self.finished = None
+        self._done = threading.Event()
+
+    def done(self) -> bool:
+        """Whether the job finished, successfully or not."""
+        return self._done.is_set()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Block until the job finished (or the timeout expired); returns whether it finished."""
+        return self._done.wait(timeout)
+
+    def _finish(self, scores: np.ndarray | None = None, error: str | None = None) -> None:
+        self.scores, self.error = scores, error
+        self.status = 'done' if error is None else 'failed'
+        self.finished = time.time()
+        self._done.set()
+
+def job_key(question: str, doc_ids: list[str]) -> tuple:
+    """Identify a similarity job, so that identical requests of several sessions are coalesced into one."""
+    return question, tuple(doc_ids)
+
+class ClipJobQueue:
+    """
+    Bounded queue of similarity jobs served by one background worker thread that owns the CLIP model.
+    Identical pending (or recently finished) jobs are coalesced, and all jobs waiting when the worker picks up work
+    are scored together: each distinct image and question goes through CLIP once per batch.
+
+    The model and its caches are only loaded by the worker, on the first batch, so that submitting never imports
+    the model's libraries. The loaders run outside of any Streamlit script, so they must not use Streamlit's caches.
+
+    Args:
+        load_model (callable): Returns the (model, processor), loading them on first call.
+        load_store (callable | None): Returns the precomputed image embedding store (see `embedding_store.load_embedding_store`)
+            or None -- called once; only the images missing from the store are encoded.
+        load_txt_cache (callable | None): Returns the cache of question embeddings matching the model (see
+            `clip_analyzer.TextEmbeddingCache`) -- called once.
+        maxsize (int): Maximum number of queued jobs -- further submissions raise `queue.Full`.
+        max_batch (int): Maximum number of jobs scored together.
+        result_ttl (float): Seconds a finished job is kept for polling and coalescing.
+    """
+    def __init__(self, load_model, load_store=None, load_txt_cache=None, maxsize: int = 64, max_batch: int = 16, result_ttl: float = 600.0):
+        self.load_model = load_model
+        self.load_store = load_store
+        self.load_txt_cache = load_txt_cache
+        self._resources = {} # 'store' & 'txt_cache', loaded by the worker on first use
+        self.max_batch = max_batch
+        self.result_ttl = result_ttl
+        self.stats = {'submitted': 0, 'coalesced': 0, 'rejected': 0, 'batches': 0, 'completed': 0, 'failed': 0}
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._jobs = {} # key -> job, pending or finished within `result_ttl`
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name="clip-job-worker", daemon=True)
+        self._worker.start()
+
+    def submit(self, question: str, doc_ids: list[str], img_paths: list[str]) -> SimilarityJob:
+        """
+        Queue a similarity job, or join an identical one already pending or recently finished.
+
+        Args:
+            question (str): Question to score the images against.
+            doc_ids (list): Doc IDs of the images.
+            img_paths (list): Paths to the image files, aligned with `doc_ids`.
+
+        Returns:
+            job (SimilarityJob): The job to poll.
+
+        Raises:
+            queue.Full: If the queue is at capacity.
+        """
+        key = job_key(question, doc_ids)
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(key)
+            # Failed jobs are retried (e.g., after the model failed to load)
+            if job is not None and job.status != 'failed':
+                self.stats['coalesced'] += 1
+                return job
+            job = SimilarityJob(question, doc_ids, img_paths)
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self.stats['rejected'] += 1
+                raise
+            self._jobs[key] = job
+            self.stats['submitted'] += 1
+        return job
+
+    def get(self, key: tuple) -> SimilarityJob | None:
+        """The pending or recently finished job of a key (see `job_key`), if any."""
+        with self._lock:
+            return self._jobs.get(key)
+
+    def pending(self) -> int:
+        """Number of queued jobs."""
+        return self._queue.qsize()
+
+    def _expire(self) -> None:
+        """Forget the jobs finished longer than `result_ttl` ago (with the lock held)."""
+        now = time.time()
+        for key in [key for key, job in self._jobs.items() if job.finished is not None and now - job.finished > self.result_ttl]:
+            del self._jobs[key]
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            # Take whatever else is waiting, so that concurrent sessions share one pass
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for job in batch:
+                job.status = 'running'
+            try:
+                with metrics.stage('job_queue.batch'):
+                    all_scores = self._score(batch)
+            except Exception as e: # reported by every job of the batch, the worker keeps serving
+                print(f"Warning: CLIP similarity jobs failed. Error: {e}")
+                for job in batch:
+                    job._finish(error=str(e))
+                self.stats['failed'] += len(batch)
+            else:
+                for job, scores in zip(batch, all_scores):
+                    job._finish(scores=scores)
+                self.stats['completed'] += len(batch)
+            self.stats['batches'] += 1
+
+    def _resource(self, name: str, load):
+        """Load a resource of the worker once (failures are retried on the next batch)."""
+        if name not in self._resources:
+            self._resources[name] = load() if load else None
+        return self._resources[name]
+
+    def _score(self, batch: list[SimilarityJob]) -> list[np.ndarray]:
+        """Score a batch of jobs, encoding each distinct image and question once."""
+        from clip_analyzer import get_img_embeddings, get_txt_embeddings # loaded along with the model
+
+        model, processor = self.load_model()
+        store = self._resource('store', self.load_store)
+        img_paths = {}
+        for job in batch:
+            img_paths.update(zip(job.doc_ids, job.img_paths))
+        doc_ids = list(img_paths)
+        # Reuse the precomputed embeddings where possible and only encode the cache misses
+        embeds = lookup_img_embeddings(store, doc_ids, [img_paths[d] for d in doc_ids])
+        missing = [d for d in doc_ids if d not in embeds]
+        metrics.count('embedding_store.hits', len(doc_ids) - len(missing))
+        metrics.count('embedding_store.misses', len(missing))
+        if missing:
+            with metrics.stage('clip.image_embeddings'):
+                encoded = get_img_embeddings([img_paths[d] for d in missing], model, processor, use_cache=True)
+            embeds.update(zip(missing, encoded))
+        with metrics.stage('clip.text_embeddings'):
+            questions = [job.question for job in batch]
+            txt_embeds = get_txt_embeddings(questions, model, processor, cache=self._resource('txt_cache', self.load_txt_cache))
+        # Cosine similarity <==> dot product of the normalized embeddings (unreadable images score 0.0)
+        return [np.nan_to_num(np.stack([embeds[d] for d in job.doc_ids]) @ txt_embed) for job, txt_embed in zip(batch, txt_embeds)]
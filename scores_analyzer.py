@@ -1,13 +1,21 @@
-import torch
+import os
+import csv
+import json
+import zlib
+import queue
+import argparse
+import threading
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from os import path
-from PIL import Image
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from data_loader import load_data, construct_lookups
-from clip_analyzer import load_clip
+from data_loader import load_data, load_lookups, group_by_conversation
+from image_cache import preprocess_img
+from embedding_store import TEXT_CACHE_FILENAME
+# torch & transformers (`clip_analyzer`) are only imported to score, not for --report or --merge
 
 
 # Define global directories and paths
@@ -15,63 +23,480 @@ DATA_DIR = './data/'
 QS_PATH = path.join(DATA_DIR, 'MMCoQA_dev.txt')
 IMGS_JSONL_PATH = path.join(DATA_DIR, 'multimodalqa_final_dataset_pipeline_camera_ready_MMQA_images.jsonl')
 IMG_FILES_DIR = path.join(DATA_DIR, 'final_dataset_images')
+SCORES_PATH = path.join(DATA_DIR, 'clip_scores.csv')
+SCORE_COLUMNS = ['qid', 'doc_id', 'score']
+TEXT_CACHE_PATH = path.join(DATA_DIR, 'clip_embeddings', TEXT_CACHE_FILENAME) # shared with the app
+REPORT_DIR = path.join(DATA_DIR, 'reports')
+# Scores below this are considered weak Q-I alignments (upon testing, maximum = 0.382)
+LOW_SCORE_THRESHOLD = 0.40
+# Groupings of the report: name -> metadata columns (every grouping is also split by 'split')
+REPORT_GROUPINGS = {
+    'split': [],
+    'conversation': ['conv_id'],
+    'turn': ['turn'],
+    'num_evidences': ['num_evidences'],
+    'modality': ['answer_modality'],
+}
 
-# Modified get_img_txt_similarity to handle NaN returns
-def get_img_txt_similarity(img_path: str, text: str, model, processor) -> float:
-    """Calculates cosine similarity between an image and a text."""
-    try:
-        img = Image.open(img_path)
-    except Exception:
-        return np.nan # Return NaN instead of 0.0 for certain errors
-    # Encode both text and image with the wrapped encoders
-    inputs = processor(text=[text], images=img, return_tensors="pt", padding=True) # no computation -> no necessity to move to GPU
-    # Move inputs to the same device as the model (as the model is moved to GPU if available)
-    inputs = {k: v.to(model.device) for k, v in inputs.items()} # keys are 'input_ids', 'attention_mask', 'pixel_values'
-    # Disable gradient calculation for inference for efficiency
-    with torch.no_grad(): 
-        outputs = model(**inputs) # Output keys: ['logits_per_image', 'logits_per_text', 'text_embeds', 'image_embeds', 'text_model_output', 'vision_model_output'] 
-    # logits <==> similarity * exp, last_hidden_state <==> prior to NN head, pooler_output <==> after one linear layer (pooling), 
-    # Utilize the embeddings for similarity calculation
-    img_embeds = outputs.image_embeds
-    text_embeds = outputs.text_embeds
-    # Normalize (along the dimension of each vector's elements) embeddings for accurate cosine similarity
-    normed_img_embed = img_embeds / img_embeds.norm(dim=-1, keepdim=True) # compute Euclidean norm for each vector
-    normed_txt_embed = text_embeds / text_embeds.norm(dim=-1, keepdim=True) # make sure the dimensions/shape are the same
-    # Calculate similarity using matrix multiplication (i.e., dot product of normalized vectors <==> cosine similarity)
-    similarity = (normed_txt_embed @ normed_img_embed.T).item() # extract the scalar values from the tensors
-    
-    return similarity
+def collect_pairs(all_turns: list[dict], imgs_lookups: dict[str, dict], img_files_dir: str, shard: tuple[int, int] = (0, 1)) -> list[dict]:
+    """
+    Collects all (question, image evidence) pairs of the given turns that belong to the given shard.
 
+    Args:
+        all_turns (list): List of JSON-format questions.
+        imgs_lookups (dict): Dictionary mapping image doc IDs to their metadata.
+        img_files_dir (str): Directory holding the image files.
+        shard (tuple): (index, count) of the shard -- turns are assigned to shards by a stable hash of their qid.
 
-if __name__ == "__main__":
-    # Load Data and Model
-    all_turns = load_data(QS_PATH)
-    imgs_lookups = construct_lookups(load_data(IMGS_JSONL_PATH))
-    model, processor = load_clip()
-    all_scores = []
-    print("Computing Q-I similarity scores across the dataset...\n")
-    # tqdm for the progress visualization of the loop
-    for turn in tqdm(all_turns, desc="Processing Turns"):
-        q = turn.get("question")
+    Returns:
+        pairs (list): Dictionaries with the 'qid', 'doc_id', 'question' and 'img_path' of each distinct pair.
+    """
+    shard_index, shard_count = shard
+    pairs = []
+    seen = set() # an image cited twice by the same turn is scored once
+    for turn in all_turns:
+        # A stable hash (unlike the built-in `hash`) so that every machine agrees on the split
+        if zlib.crc32(turn['qid'].encode('utf-8')) % shard_count != shard_index:
+            continue
         # Loop through each image evidence in the answer if there's more than one
         for a in turn.get("answer", []):
             if a.get("modality") == "image":
                 for instance in a.get("image_instances", []):
                     img_id = instance.get("doc_id")
                     # In case the evidence's somehow not found
-                    if img_id in imgs_lookups:
-                        img_filename = imgs_lookups[img_id].get("path")
-                        # In case the image evidence failed to load
-                        if img_filename:
-                            img_path = path.join(IMG_FILES_DIR, img_filename)
-                            # Compute its score and add to the list for statistical analysis if valid
-                            score = get_img_txt_similarity(img_path, q, model, processor)
-                            if not np.isnan(score):
-                                all_scores.append(score)
-    if not all_scores:
+                    if img_id in imgs_lookups and imgs_lookups[img_id].get("path") and (turn['qid'], img_id) not in seen:
+                        seen.add((turn['qid'], img_id))
+                        pairs.append({'qid': turn['qid'], 'doc_id': img_id, 'question': turn.get("question"),
+                                      'img_path': path.join(img_files_dir, imgs_lookups[img_id]["path"])})
+    return pairs
+
+def load_completed(scores_path: str) -> set[tuple[str, str]]:
+    """
+    Reads the (qid, doc_id) pairs already scored in a checkpoint file.
+    A last row cut off by a crash (i.e., without its line break) is not counted, see `truncate_partial_row`.
+
+    Args:
+        scores_path (str): Path to the CSV checkpoint.
+
+    Returns:
+        completed (set): Set of (qid, doc_id) tuples.
+    """
+    if not path.exists(scores_path):
+        return set()
+    completed = set()
+    with open(scores_path, 'r', encoding='utf-8', newline='') as file:
+        reader = csv.reader(line for line in file if line.endswith('\n'))
+        next(reader, None) # header
+        for row in reader:
+            # Only fully parsed rows count as done
+            if len(row) != len(SCORE_COLUMNS):
+                continue
+            try:
+                float(row[2])
+            except ValueError:
+                continue
+            completed.add((row[0], row[1]))
+    return completed
+
+def truncate_partial_row(scores_path: str, chunk_size: int = 1 << 16) -> int:
+    """
+    Cuts a checkpoint file back to its last line break, dropping a row half-written by a crash or Ctrl-C,
+    so that the next append does not get glued onto it.
+
+    Args:
+        scores_path (str): Path to the CSV checkpoint.
+        chunk_size (int): Number of bytes read at a time, backwards from the end of the file.
+
+    Returns:
+        dropped (int): Number of bytes cut off.
+    """
+    if not path.exists(scores_path):
+        return 0
+    with open(scores_path, 'rb+') as file:
+        size = file.seek(0, os.SEEK_END)
+        keep, end = 0, size
+        while end > 0:
+            start = max(0, end - chunk_size)
+            file.seek(start)
+            newline = file.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                keep = start + newline + 1
+                break
+            end = start
+        if keep < size:
+            file.truncate(keep)
+            print(f"Warning: Dropped a partially written row at the end of {scores_path}.")
+    return size - keep
+
+def check_checkpoint_model(scores_path: str, tag: str) -> None:
+    """
+    Makes sure a checkpoint is only ever resumed with the model that produced its scores, recording the model
+    (see `clip_analyzer.model_tag`) in a '<checkpoint>.meta.json' sidecar on first use.
+
+    Args:
+        scores_path (str): Path to the CSV checkpoint.
+        tag (str): Checkpoint & backend of the model about to score.
+
+    Raises:
+        ValueError: If the checkpoint holds scores of another model, or scores of an unknown model.
+    """
+    meta_path = scores_path + '.meta.json'
+    has_scores = bool(load_completed(scores_path))
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as file:
+            recorded = json.load(file).get('model')
+    except (OSError, ValueError):
+        recorded = None
+    if has_scores and recorded != tag:
+        found = f"model '{recorded}'" if recorded else "an unknown model (no metadata)"
+        raise ValueError(f"{scores_path} holds scores of {found}, not '{tag}' -- use another --output or delete it to start over")
+    if recorded != tag:
+        with open(meta_path, 'w', encoding='utf-8') as file:
+            json.dump({'model': tag, 'columns': SCORE_COLUMNS}, file)
+
+# Processor of each worker process, set once by the pool initializer instead of being pickled per task
+_worker_processor = None
+
+def _init_worker(processor) -> None:
+    global _worker_processor
+    _worker_processor = processor
+    import torch
+    torch.set_num_threads(1) # leave the cores to the other workers and the inference stage
+
+def _preprocess_in_worker(img_path: str) -> "torch.Tensor | None":
+    return preprocess_img(img_path, _worker_processor)
+
+def score_pairs(pairs: list[dict], model, processor, scores_path: str, batch_size: int = 32, num_workers: int = 4,
+                use_processes: bool = False, prefetch: int = 4, txt_cache: "TextEmbeddingCache | None" = None) -> int:
+    """
+    Scores the pairs with a producer-consumer pipeline and streams the results to an append-only CSV checkpoint:
+    a worker pool decodes & pre-processes images, the main thread encodes them in batches, and every finished batch
+    is appended (and flushed) to the checkpoint so that an interrupted run loses at most one batch.
+
+    Args:
+        pairs (list): Pairs as returned by `collect_pairs`, without the already completed ones.
+        model (CLIPModel): Pretrained CLIP model.
+        processor (CLIPProcessor): Pretrained CLIP processor.
+        scores_path (str): Path to the CSV checkpoint to append to.
+        batch_size (int): Number of images encoded per forward pass.
+        num_workers (int): Number of threads/processes decoding & pre-processing images.
+        use_processes (bool): Whether to decode in a process pool instead of a thread pool.
+        prefetch (int): Maximum number of pre-processed batches waiting for inference.
+        txt_cache (TextEmbeddingCache | None): Cache of question embeddings matching the model.
+
+    Returns:
+        count (int): Number of scores written.
+    """
+    import torch
+    from clip_analyzer import encode_pixel_values, get_txt_embeddings
+    # Duplicated pairs would be scored and written twice
+    pairs = list({(p['qid'], p['doc_id']): p for p in pairs}.values())
+    # Each distinct question goes through the text tower at most once (NaN rows are never produced for texts)
+    questions = list(dict.fromkeys(p['question'] for p in pairs))
+    txt_embeds = dict(zip(questions, get_txt_embeddings(questions, model, processor, cache=txt_cache)))
+    # Group the pairs by image so that each image is decoded and encoded once
+    pairs_by_img = {}
+    for p in pairs:
+        pairs_by_img.setdefault(p['img_path'], []).append(p)
+    img_paths = list(pairs_by_img)
+    batches = queue.Queue(maxsize=prefetch) # bounded so that decoding cannot run arbitrarily far ahead
+    stop = threading.Event()
+
+    def produce() -> None:
+        if use_processes:
+            pool = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(processor,))
+            preprocess = _preprocess_in_worker
+        else:
+            pool = ThreadPoolExecutor(max_workers=num_workers)
+            preprocess = lambda img_path: preprocess_img(img_path, processor)
+        try:
+            for start in range(0, len(img_paths), batch_size):
+                if stop.is_set():
+                    break
+                batch_paths = img_paths[start:start + batch_size]
+                batches.put((batch_paths, list(pool.map(preprocess, batch_paths))))
+        finally:
+            pool.shutdown(cancel_futures=True)
+            batches.put(None) # sentinel
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    truncate_partial_row(scores_path)
+    is_new = not path.exists(scores_path) or os.stat(scores_path).st_size == 0
+    count = 0
+    try:
+        with open(scores_path, 'a', encoding='utf-8', newline='') as file, tqdm(total=len(pairs), desc="Scoring Pairs") as progress:
+            writer = csv.writer(file)
+            if is_new:
+                writer.writerow(SCORE_COLUMNS)
+            while (item := batches.get()) is not None:
+                batch_paths, pixel_values = item
+                valid = [i for i, pv in enumerate(pixel_values) if pv is not None]
+                rows = []
+                if valid:
+                    img_embeds = encode_pixel_values(torch.stack([pixel_values[i] for i in valid]), model)
+                    for embed, i in zip(img_embeds, valid):
+                        for p in pairs_by_img[batch_paths[i]]:
+                            rows.append([p['qid'], p['doc_id'], float(embed @ txt_embeds[p['question']])])
+                # Unreadable images are recorded as NaN so that reruns do not retry them
+                for i, pv in enumerate(pixel_values):
+                    if pv is None:
+                        rows.extend([p['qid'], p['doc_id'], np.nan] for p in pairs_by_img[batch_paths[i]])
+                writer.writerows(rows)
+                file.flush()
+                count += len(rows)
+                progress.update(len(rows))
+    finally:
+        # Let the producer wind down on errors or Ctrl-C
+        stop.set()
+        while producer.is_alive():
+            try:
+                batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    return count
+
+def merge_scores(input_paths: list[str], output_path: str) -> pd.DataFrame:
+    """
+    Merges the checkpoints of several shards into one file, keeping the first score of any duplicated pair.
+
+    Args:
+        input_paths (list): Paths to the CSV checkpoints.
+        output_path (str): Path to the merged file (written as Parquet if it ends with '.parquet', CSV otherwise).
+
+    Returns:
+        merged (pd.DataFrame): The merged scores.
+
+    Raises:
+        ValueError: If the checkpoints were scored by different models (see `check_checkpoint_model`).
+    """
+    # Shards scored by different models must not be mixed
+    tags = set()
+    for input_path in input_paths:
+        try:
+            with open(input_path + '.meta.json', 'r', encoding='utf-8') as file:
+                tags.add(json.load(file).get('model'))
+        except (OSError, ValueError):
+            tags.add(None)
+    if len(tags) > 1:
+        raise ValueError(f"The checkpoints were scored by different (or unknown) models: {sorted(map(str, tags))}")
+    frames = [pd.read_csv(p, dtype={'qid': str, 'doc_id': str}) for p in input_paths]
+    merged = pd.concat(frames, ignore_index=True).drop_duplicates(subset=['qid', 'doc_id'])
+    if tags != {None}:
+        with open(output_path + '.meta.json', 'w', encoding='utf-8') as file:
+            json.dump({'model': tags.pop(), 'columns': SCORE_COLUMNS}, file)
+    if output_path.endswith('.parquet'):
+        merged.to_parquet(output_path, index=False)
+    else:
+        merged.to_csv(output_path, index=False)
+    return merged
+
+def load_scores(input_paths: list[str]) -> pd.DataFrame:
+    """
+    Loads score files (CSV checkpoints or merged Parquet files) into one DataFrame.
+
+    Args:
+        input_paths (list): Paths to the score files.
+
+    Returns:
+        scores (pd.DataFrame): The 'qid', 'doc_id' and 'score' columns, with categorical IDs to keep millions of rows compact.
+    """
+    frames = []
+    for input_path in input_paths:
+        if input_path.endswith('.parquet'):
+            frame = pd.read_parquet(input_path, columns=SCORE_COLUMNS)
+        else:
+            frame = pd.read_csv(input_path, dtype={'qid': str, 'doc_id': str}, engine='pyarrow') # multi-threaded parsing
+        frames.append(frame.astype({'qid': 'category', 'doc_id': 'category', 'score': 'float32'}))
+    if not frames:
+        return pd.DataFrame(columns=SCORE_COLUMNS)
+    # Union the categories so that concatenating keeps them categorical
+    return pd.concat(frames, ignore_index=True).astype({'qid': 'category', 'doc_id': 'category'})
+
+def turn_metadata(all_turns: list[dict]) -> pd.DataFrame:
+    """
+    Describes every turn by the attributes the scores are grouped by.
+
+    Args:
+        all_turns (list): List of JSON-format questions.
+
+    Returns:
+        metadata (pd.DataFrame): One row per qid with its 'conv_id', 'turn' position (starting at 1), 'num_evidences'
+        (image/text instances plus one per table answer) and 'answer_modality' (e.g., 'image' or 'image+table').
+    """
+    conversations = group_by_conversation(all_turns)
+    rows = []
+    for conv_id, conv in conversations.items():
+        for position, turn in enumerate(conv, start=1):
+            answers = turn.get('answer', [])
+            num_evidences = sum(len(a.get('image_instances', [])) + len(a.get('text_instances', [])) + bool(a.get('table_indices'))
+                                for a in answers)
+            modality = '+'.join(sorted({a.get('modality', '?') for a in answers})) or '?'
+            rows.append((turn['qid'], conv_id, position, num_evidences, modality))
+    return pd.DataFrame(rows, columns=['qid', 'conv_id', 'turn', 'num_evidences', 'answer_modality'])
+
+def summarize_scores(table: pd.DataFrame, by: list[str]) -> pd.DataFrame:
+    """
+    Computes the summary statistics of the scores per group in one vectorized pass.
+
+    Args:
+        table (pd.DataFrame): Scores joined with their turn metadata and 'split'.
+        by (list): Columns to group by.
+
+    Returns:
+        stats (pd.DataFrame): Count, mean, median, standard deviation, extremes and share of low scores per group.
+    """
+    valid = table[table['score'].notna()].assign(is_low=lambda df: df['score'] < LOW_SCORE_THRESHOLD)
+    return valid.groupby(by, observed=True, sort=True).agg(
+        count=('score', 'size'), mean=('score', 'mean'), median=('score', 'median'), std=('score', 'std'),
+        min=('score', 'min'), max=('score', 'max'), low_share=('is_low', 'mean'),
+    ).reset_index()
+
+def plot_report(table: pd.DataFrame, stats: dict[str, pd.DataFrame], report_dir: str) -> list[str]:
+    """
+    Saves static plots of the score distributions and the grouped means (without opening any window).
+
+    Args:
+        table (pd.DataFrame): Scores joined with their turn metadata and 'split'.
+        stats (dict): Grouped statistics as returned by `summarize_scores`, keyed by grouping name.
+        report_dir (str): Directory to write the PNG files to.
+
+    Returns:
+        plot_paths (list): Paths to the written plots.
+    """
+    plot_paths = []
+    # Score distribution per split, overlaid
+    fig, ax = plt.subplots(figsize=(12, 6))
+    for split, scores in table.groupby('split', observed=True)['score']:
+        ax.hist(scores.dropna().to_numpy(), bins=50, alpha=0.5, density=True, label=str(split))
+    ax.axvline(LOW_SCORE_THRESHOLD, color='g', linestyle=':', linewidth=2, label=f'Threshold = {LOW_SCORE_THRESHOLD:.2f}')
+    ax.set(title='Distribution of CLIP Q-I Similarity Scores per Split', xlabel='CLIP Similarity Score', ylabel='Density')
+    ax.legend()
+    plot_paths.append(path.join(report_dir, 'score_distribution.png'))
+    fig.tight_layout()
+    fig.savefig(plot_paths[-1], dpi=120)
+    plt.close(fig)
+    # Mean score per group and split (conversations are too many to plot, they are only written to Parquet)
+    for name, column in [('turn', 'turn'), ('num_evidences', 'num_evidences'), ('modality', 'answer_modality')]:
+        means = stats[name].pivot(index=column, columns='split', values='mean')
+        fig, ax = plt.subplots(figsize=(12, 6))
+        if name == 'turn':
+            means.plot(ax=ax, kind='line', marker='o') # ordered positions
+        else:
+            means.plot(ax=ax, kind='bar', rot=0)
+        ax.set(title=f'Mean CLIP Q-I Similarity Score by {column}', xlabel=column, ylabel='Mean CLIP Similarity Score')
+        plot_paths.append(path.join(report_dir, f'score_by_{name}.png'))
+        fig.tight_layout()
+        fig.savefig(plot_paths[-1], dpi=120)
+        plt.close(fig)
+    return plot_paths
+
+def report_scores(splits: list[tuple[str, str, str]], report_dir: str) -> dict[str, pd.DataFrame]:
+    """
+    Reporting mode: groups precomputed scores of one or more splits by conversation, turn position, number of evidences
+    and answer modality, and writes the statistics as Parquet plus static plots -- without loading the model.
+
+    Args:
+        splits (list): (name, scores path, questions path) of each split, e.g. ('dev', 'data/clip_scores.csv', 'data/MMCoQA_dev.txt').
+        report_dir (str): Directory to write the report to.
+
+    Returns:
+        stats (dict): Grouped statistics keyed by grouping name (see `REPORT_GROUPINGS`).
+    """
+    tables = []
+    for name, scores_path, qs_path in splits:
+        scores = load_scores([scores_path])
+        metadata = turn_metadata(load_data(qs_path))
+        # qids are only unique within a split, so the join happens per split
+        table = scores.merge(metadata.astype({'qid': 'category'}), on='qid', how='left')
+        missing = table['conv_id'].isna().sum()
+        if missing:
+            print(f"Warning: {missing} scores of split '{name}' have no matching question in {qs_path}.")
+        tables.append(table.assign(split=name))
+    table = pd.concat(tables, ignore_index=True).astype({'split': 'category', 'conv_id': 'category', 'answer_modality': 'category'})
+    os.makedirs(report_dir, exist_ok=True)
+    stats = {}
+    for name, by in REPORT_GROUPINGS.items():
+        stats[name] = summarize_scores(table, ['split'] + by)
+        stats[name].to_parquet(path.join(report_dir, f'stats_by_{name}.parquet'), index=False)
+    plot_report(table, stats, report_dir)
+    return stats
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """Parse a '--shard i/n' flag into (i, n)."""
+    try:
+        index, count = (int(x) for x in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}' -- expected the form i/n, e.g. 0/4")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}' -- i must be in [0, n)")
+    return index, count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute Q-I CLIP similarity scores across the dataset and summarize them.")
+    parser.add_argument('--qs-path', default=QS_PATH, help="Path to the MMCoQA questions file.")
+    parser.add_argument('--output', default=None, help="Append-only CSV checkpoint (defaults to data/clip_scores[.i-of-n].csv).")
+    parser.add_argument('--shard', type=parse_shard, default=(0, 1), help="Only score shard i of n, e.g. --shard 0/4.")
+    parser.add_argument('--batch-size', type=int, default=32, help="Number of images encoded per forward pass.")
+    parser.add_argument('--num-workers', type=int, default=4, help="Number of image decoding workers.")
+    parser.add_argument('--processes', action='store_true', help="Decode images in a process pool instead of a thread pool.")
+    parser.add_argument('--checkpoint', default='large', help="CLIP checkpoint to score with (or 'small'/'large').")
+    parser.add_argument('--backend', default='fp32', help="CLIP inference backend (see `clip_analyzer.CLIP_BACKENDS`).")
+    parser.add_argument('--num-threads', type=int, default=None, help="Intra-op threads for inference.")
+    parser.add_argument('--merge', nargs='+', metavar='CHECKPOINT', help="Merge shard checkpoints into --output instead of scoring.")
+    parser.add_argument('--report', nargs=3, action='append', metavar=('SPLIT', 'SCORES', 'QUESTIONS'),
+                        help="Report grouped statistics of precomputed scores instead of scoring; repeat for multiple splits, e.g. --report dev data/clip_scores.csv data/MMCoQA_dev.txt.")
+    parser.add_argument('--report-dir', default=REPORT_DIR, help="Output directory of --report.")
+    args = parser.parse_args()
+
+    if args.report:
+        stats = report_scores([tuple(split) for split in args.report], args.report_dir)
+        print(stats['split'].to_string(index=False))
+        print(f"\nReport written to {args.report_dir}.")
+        raise SystemExit(0)
+
+    if args.merge:
+        output_path = args.output or SCORES_PATH
+        try:
+            merged = merge_scores(args.merge, output_path)
+        except ValueError as e:
+            print(f"Error: {e}")
+            raise SystemExit(1)
+        print(f"Merged {len(merged)} scores into {output_path}.")
+        raise SystemExit(0)
+    from clip_analyzer import CLIP_BACKENDS, TextEmbeddingCache, load_clip, model_tag
+    if args.backend not in CLIP_BACKENDS:
+        parser.error(f"argument --backend: invalid choice: '{args.backend}' (choose from {', '.join(CLIP_BACKENDS)})")
+    shard_index, shard_count = args.shard
+    output_path = args.output or (SCORES_PATH if shard_count == 1 else SCORES_PATH.replace('.csv', f'.{shard_index}-of-{shard_count}.csv'))
+    # Load Data and Model
+    all_turns = load_data(args.qs_path)
+    imgs_lookups = load_lookups(IMGS_JSONL_PATH)
+    pairs = collect_pairs(all_turns, imgs_lookups, IMG_FILES_DIR, shard=args.shard)
+    # Resume only a checkpoint scored by the same model & backend
+    try:
+        check_checkpoint_model(output_path, model_tag(args.checkpoint, args.backend))
+    except ValueError as e:
+        print(f"Error: {e}")
+        raise SystemExit(1)
+    # Skip the pairs completed by a previous (interrupted) run
+    completed = load_completed(output_path)
+    remaining = [p for p in pairs if (p['qid'], p['doc_id']) not in completed]
+    print(f"{len(pairs)} Q-I pairs in shard {shard_index}/{shard_count}, {len(pairs) - len(remaining)} already scored.\n")
+    if remaining:
+        model, processor = load_clip(args.checkpoint, backend=args.backend, num_threads=args.num_threads)
+        # Reuse the question embeddings of earlier runs (or of `embedding_store.py --questions`) and keep the new ones
+        txt_cache = TextEmbeddingCache(model_tag(args.checkpoint, args.backend), maxsize=1 << 20, cache_path=TEXT_CACHE_PATH)
+        print("Computing Q-I similarity scores across the dataset...\n")
+        score_pairs(remaining, model, processor, output_path, batch_size=args.batch_size,
+                    num_workers=args.num_workers, use_processes=args.processes, txt_cache=txt_cache)
+        txt_cache.save()
+    # Keep only the valid scores for statistical analysis (NaN for images that could not be opened)
+    scores_array = load_scores([output_path])['score'].dropna().to_numpy() if path.exists(output_path) else np.array([])
+    if not len(scores_array):
         print("No valid image-question pairs were found or processed -- Please Check Data")
     else:
-        scores_array = np.array(all_scores)
         # Compute summary statistics with numpy array methods
         avg_score = np.mean(scores_array)
         median_score = np.median(scores_array)
@@ -83,7 +508,7 @@ if __name__ == "__main__":
         proportion_below = (len(below_threshold) / len(scores_array)) * 100
         
         print("**Summary Statistics of Q-I Similarity Scores:**")
-        print(f"Total Image Instances Analyzed: {len(all_scores)}")
+        print(f"Total Image Instances Analyzed: {len(scores_array)}")
         print(f"Average Score: {avg_score:.3f}")
         print(f"Median Score: {median_score:.3f}")
         print(f"Maximum Score: {max_score:.3f}")